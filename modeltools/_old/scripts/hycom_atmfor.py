@@ -12,6 +12,8 @@ import modeltools.tools
 #from mpl_toolkits.basemap import Basemap, shiftgrid
 import logging
 import abfile
+import collections
+import multiprocessing
 
 
 _loglevel=logging.DEBUG
@@ -40,8 +42,7 @@ def plot_fig(fld,dt,varname,filename) :
 
 
 
-def atmfor(start,end,af,grid_file="regional.grid",blkdat_file="blkdat.input",plot_diag=False,
-      nersc_forcing=False) :
+def forcing_property_set(nersc_forcing) :
 
    if nersc_forcing :
       logger.info("Using old NERSC-HYCOM forcing fields")
@@ -80,6 +81,130 @@ def atmfor(start,end,af,grid_file="regional.grid",blkdat_file="blkdat.input",plo
          modeltools.hycom.variable_units,
          modeltools.hycom.variable_limits,
          modeltools.forcing.atmosphere.known_vectors)
+   return forcingpropertyset
+
+
+
+def process_timestep(af,dt,forcingpropertyset,mlon,mlat,wndflg,lwflag,nersc_forcing=False,dtype=None) :
+   """ Reads, derives, interpolates, rotates and limits all fields at time dt. Returns
+   dict mapping known names to (field on model grid, time of field) """
+
+   logger.info("Reading at %s"%str(dt))
+   #print af.known_names
+
+   # Read variables
+   af.get_timestep(dt)
+
+   # Estimate dependent variable on native grid
+   # radflx is downwelling longwave radiation
+   # TODO: HYCOM-specific
+   derived=[]
+   if wndflg in [1,2,3] :
+       derived.extend(["taux","tauy","wspd","ustar"])
+
+
+   #  Forcing used by old NERSC-HYCOM
+   if nersc_forcing :
+      if "relhum" not in af.known_names_explicit : derived.append("relhum")
+   #  Forcing used by new version 
+   else :
+      if "vapmix" not in af.known_names_explicit : derived.append("vapmix")
+      if "ssrd"   not in af.known_names_explicit : derived.extend(["ssrd","sradtop"])
+      if lwflag == -1 :
+          if "strd"   not in af.known_names_explicit : derived.append("strd")
+      else :
+          raise ValueError,"TODO: lwflag<>-1 not supported"
+
+   # Intermediates shared by the derived fields are computed once
+   af.calculate(derived,dtype=dtype)
+
+   # Fields that will be written
+   # TODO: HYCOM-specific
+   outnames = [elem for elem in af.known_names if elem in forcingpropertyset.keys()]
+
+   # Interpolation of all fields and unit conversion
+   newfld={}
+   for kn in outnames :
+
+       # Coordinates
+       lo,la=af[kn].coords
+
+       # Read and convert field to units used by HYCOM
+      # TODO: HYCOM-specific
+       fld=af[kn].data_to_unit(forcingpropertyset[kn].cfunit)
+
+       #TODO: : Possible to choose interpolation here
+       # Interpolation weights are computed once per source grid and reused by all fields and time steps
+       fi=modeltools.tools.get_field_interpolator(modeltools.tools.FieldInterpolatorBilinear,lo,la,mlon,mlat)
+       newfld[kn]=fi.interpolate(fld)
+
+   # Do rotation of u and v components if this the first component of a vector field
+   for kn in af.known_names :
+       if kn in modeltools.forcing.atmosphere.known_vectors.keys() and kn in outnames :
+           knu,knv = modeltools.forcing.atmosphere.known_vectors[kn]
+           logger.info("Rotating %s,%s "%(knu,knv))
+           ur,vr=modeltools.tools.rotate_vector(newfld[knu],newfld[knv],mlon,mlat)
+           newfld[knu]=ur
+           newfld[knv]=vr
+
+   # Apply limits if specified
+   for kn in outnames :
+      newfld[kn] = forcingpropertyset[kn].apply_limit(newfld[kn])
+
+   return dict([(kn,(newfld[kn],af[kn].time)) for kn in outnames])
+
+
+
+def _read_only_grid(mlon,mlat) :
+   # Model grid is not modified. Interpolators to read-only grids are reused, see get_field_interpolator
+   for elem in [mlon,mlat] :
+      elem.flags.writeable=False
+   return mlon,mlat
+
+
+
+# State of worker processes used by atmfor, set by _init_worker
+_worker = {}
+
+def _init_worker(afargs,afkwargs,mlon,mlat,kwargs) :
+   # Each worker reads from its own AtmosphericForcing object
+   mlon,mlat = _read_only_grid(mlon,mlat)
+   af=modeltools.forcing.atmosphere.AtmosphericForcing(*afargs,**afkwargs)
+   af.set_target_grid(mlon,mlat)
+   _worker["af"]     = af
+   _worker["mlon"]   = mlon
+   _worker["mlat"]   = mlat
+   _worker["kwargs"] = kwargs
+   _worker["forcingpropertyset"] = forcing_property_set(kwargs["nersc_forcing"])
+
+
+def _process_slice(dts) :
+   # Processes a contiguous slice of time steps in a worker process
+   return [process_timestep(_worker["af"],dt,_worker["forcingpropertyset"],_worker["mlon"],_worker["mlat"],
+                            **_worker["kwargs"]) for dt in dts]
+
+
+
+def _ordered_results(pool,func,slices,maxpending) :
+   # Yields func(dts) for dts in slices (ex _process_slice), in the order of slices. At most
+   # maxpending slices are submitted at a time, so that workers do not get too far ahead of the writer
+   pending = collections.deque()
+   for dts in slices :
+      pending.append(pool.apply_async(func,(dts,)))
+      if len(pending) >= maxpending :
+         yield pending.popleft().get()
+   while pending :
+      yield pending.popleft().get()
+
+
+def atmfor(start,end,af,grid_file="regional.grid",blkdat_file="blkdat.input",plot_diag=False,
+      nersc_forcing=False,dtype=None,nproc=1,slicesize=None) :
+   """ Creates HYCOM forcing files from start to end. If nproc > 1, the time steps are split
+   in contiguous slices of slicesize time steps (default af.window, or 8), which are processed by
+   a pool of nproc processes with their own AtmosphericForcing objects. Results are written
+   in time order by this process """
+
+   forcingpropertyset = forcing_property_set(nersc_forcing)
 
    # Open hycom grid file, read longitude and latitude@
    # TODO: HYCOM-specific
@@ -90,6 +215,7 @@ def atmfor(start,end,af,grid_file="regional.grid",blkdat_file="blkdat.input",plo
    Nx=mlon.shape[1]
    Ny=mlon.shape[0]
    za.close()
+   mlon,mlat = _read_only_grid(mlon,mlat)
 
    # parse blkdat to get yearflag
    # TODO: HYCOM-specific
@@ -97,111 +223,78 @@ def atmfor(start,end,af,grid_file="regional.grid",blkdat_file="blkdat.input",plo
    yrflag = blkd["yrflag"]
    wndflg = blkd["wndflg"]
    lwflag  = blkd["lwflag"]
+   kwargs = {"wndflg":wndflg,"lwflag":lwflag,"nersc_forcing":nersc_forcing,"dtype":dtype}
 
-   # Main loop 
-   ffiles={}
+   # Time steps to process
+   dts = []
    dt = start
    while dt <= end :
-       
-       logger.info("Reading at %s"%str(dt))
-       #print af.known_names
-
-       # Read variables
-       af.get_timestep(dt)
-
-       # Estimate dependent variable on native grid
-       # radflx is downwelling longwave radiation
-       # TODO: HYCOM-specific
-       if wndflg in [1,2,3] :
-           af.calculate_windstress()
-           af.calculate_windspeed()
-           af.calculate_ustar()
-
-
-       #  Forcing used by old NERSC-HYCOM
-       if nersc_forcing :
-          if "relhum" not in af.known_names_explicit : af.calculate_relhum()
-       #  Forcing used by new version 
-       else :
-          if "vapmix" not in af.known_names_explicit : af.calculate_vapmix()
-          if "ssrd"   not in af.known_names_explicit : af.calculate_ssrd()
-          if lwflag == -1 :
-              if "strd"   not in af.known_names_explicit : af.calculate_strd()
-          else :
-              raise ValueError,"TODO: lwflag<>-1 not supported"
-
-       # Open output files. Dict uses "known name" when mapping to file object
-       # TODO: HYCOM-specific
-       if dt == start :
-           for k,v in forcingpropertyset.items() :
-               if k in af.known_names :
-                  ffiles[k]=abfile.ABFileForcing(
-                        "forcing.%s"%v.name,"w",idm=Nx, jdm=Ny, 
-                        cline1=af.name,
-                        cline2="%s (%s)"%(v.name,v.cfunit))
-
-
-       # Interpolation of all fields and unit conversion
-       newfld={}
-       for kn in [elem for elem in af.known_names if elem in ffiles.keys()] :
-
-           # Coordinates
-           lo,la=af[kn].coords
-
-           # Read and convert field to units used by HYCOM
-          # TODO: HYCOM-specific
-           fld=af[kn].data_to_unit(forcingpropertyset[kn].cfunit)
-
-           #TODO: : Possible to choose interpolation here
-           fi=modeltools.tools.FieldInterpolatorBilinear(lo,la,fld,mlon,mlat)
-           newfld[kn]=fi.interpolate(fld)
-
-       # Do rotation of u and v components if this the first component of a vector field
-       for kn in af.known_names :
-           if kn in modeltools.forcing.atmosphere.known_vectors.keys() and kn in ffiles.keys() :
-               knu,knv = modeltools.forcing.atmosphere.known_vectors[kn]
-               logger.info("Rotating %s,%s "%(knu,knv))
-               ur,vr=modeltools.tools.rotate_vector(newfld[knu],newfld[knv],mlon,mlat)
-               newfld[knu]=ur
-               newfld[knv]=vr
-
-       # Apply limits if specified
-       for kn in [elem for elem in af.known_names if elem in ffiles.keys()] :
-          newfld[kn] = forcingpropertyset[kn].apply_limit(newfld[kn])
-
-       # Loop over open files and write
-       # TODO: HYCOM specific
-       for kn in ffiles.keys() :
-               
-           # Variable name used by hycom
-           vname=forcingpropertyset[kn].name
-
-           # Write to hycom file
-           newdt=af[kn].time
-           ord_day,hour,isec=modeltools.hycom.datetime_to_ordinal(newdt,yrflag)
-           dtime=modeltools.hycom.dayfor(newdt.year,ord_day,hour,yrflag)
-           ffiles[kn].write_field(newfld[kn],newfld[kn],vname,dtime,af.timestep_in_days)
-
-           # Write diagnostics, if requested
-           if plot_diag :
-              tmp="forcing.%s."%vname 
-              tmp=tmp+"%Y%m%d%H.png"
-              tmp=newdt.strftime(tmp)
-              logger.info( "plotting %s"%tmp)
-              plot_fig(newfld[kn],newdt,vname,tmp)
-
-       # Increase time
-       dt = dt + af.timestep
+      dts.append(dt)
+      dt = dt + af.timestep
+
+   # Main loop 
+   ffiles={}
+   pool = None
+   try :
+      if nproc > 1 :
+         if slicesize is None : slicesize = af.window or 8
+         slices = [dts[i:i+slicesize] for i in range(0,len(dts),slicesize)]
+         logger.info("Processing %d time steps in %d slices on %d processes"%(len(dts),len(slices),nproc))
+         pool = multiprocessing.Pool(nproc,_init_worker,
+               ((af.configfile,af.name),{"rootpath":af.rootpath,"prefetch":af.prefetch,"window":af.window},
+                mlon,mlat,kwargs))
+         results = _ordered_results(pool,_process_slice,slices,2*nproc)
+      else :
+         # Only read the part of the input fields covering the model grid
+         af.set_target_grid(mlon,mlat)
+         results = ([process_timestep(af,dt,forcingpropertyset,mlon,mlat,**kwargs)] for dt in dts)
+
+      for newflds in results :
+         for newfld in newflds :
+
+            # Open output files. Dict uses "known name" when mapping to file object
+            # TODO: HYCOM-specific
+            if not ffiles :
+                for k,v in forcingpropertyset.items() :
+                    if k in newfld.keys() :
+                       ffiles[k]=abfile.ABFileForcing(
+                             "forcing.%s"%v.name,"w",idm=Nx, jdm=Ny, 
+                             cline1=af.name,
+                             cline2="%s (%s)"%(v.name,v.cfunit))
+
+            # Loop over open files and write
+            # TODO: HYCOM specific
+            for kn in ffiles.keys() :
+                    
+                # Variable name used by hycom
+                vname=forcingpropertyset[kn].name
+
+                # Write to hycom file
+                fld,newdt=newfld[kn]
+                ord_day,hour,isec=modeltools.hycom.datetime_to_ordinal(newdt,yrflag)
+                dtime=modeltools.hycom.dayfor(newdt.year,ord_day,hour,yrflag)
+                ffiles[kn].write_field(fld,fld,vname,dtime,af.timestep_in_days)
+
+                # Write diagnostics, if requested
+                if plot_diag :
+                   tmp="forcing.%s."%vname 
+                   tmp=tmp+"%Y%m%d%H.png"
+                   tmp=newdt.strftime(tmp)
+                   logger.info( "plotting %s"%tmp)
+                   plot_fig(fld,newdt,vname,tmp)
+   finally :
+      if pool is not None :
+         pool.terminate()
+         pool.join()
        
    # CLose files            
    for kn in ffiles.keys() :
        ffiles[kn].close()
+   af.close_prefetch()
    af=[]
 
 
 
-
-
 if __name__ == "__main__" :
    class DateTimeParseAction(argparse.Action) :
        def __call__(self, parser, args, values, option_string=None):
@@ -210,6 +303,11 @@ if __name__ == "__main__" :
    parser = argparse.ArgumentParser(description='Prepare HYCOM forcing files from a set of input files')
    parser.add_argument('--plot_diag', action="store_true")
    parser.add_argument('--nersc_forcing', action="store_true")
+   parser.add_argument('--prefetch', action="store_true", help='Read next time step in the background')
+   parser.add_argument('--window', type=int, default=None, help='Read this many time steps at a time from input files')
+   parser.add_argument('--float32', action="store_true", help='Calculate derived fields in single precision')
+   parser.add_argument('--nproc', type=int, default=1, help='Number of processes processing time steps in parallel')
+   parser.add_argument('--satvap_table', action="store_true", help='Use tabulated saturation vapour pressure (relative error < 6e-7)')
    parser.add_argument('start_time', action=DateTimeParseAction, help='Start time in UTC zone. Format = YYYY-mm-ddTHH:MM:SS')
    parser.add_argument('end_time',   action=DateTimeParseAction, help='Stop  time in UTC zone. Format = YYYY-mm-ddTHH:MM:SS')
    parser.add_argument('xml_file',   type=str, help='xml file containing definition of forcing dataset(s)')
@@ -217,7 +315,10 @@ if __name__ == "__main__" :
 
    args = parser.parse_args()
 
+   if args.satvap_table :
+      modeltools.forcing.atmosphere.set_satvap_table()
 
    # Set up AtmosphericForcing object, which keeps track of data to be read
-   af=modeltools.forcing.atmosphere.AtmosphericForcing(args.xml_file,args.xml_id)
-   atmfor(args.start_time,args.end_time,af,plot_diag=args.plot_diag,nersc_forcing=args.nersc_forcing)#,gridfile="regional.grid",blkdat_file="blkdat.input")
+   af=modeltools.forcing.atmosphere.AtmosphericForcing(args.xml_file,args.xml_id,prefetch=args.prefetch,window=args.window)
+   atmfor(args.start_time,args.end_time,af,plot_diag=args.plot_diag,nersc_forcing=args.nersc_forcing,
+         dtype=numpy.float32 if args.float32 else None,nproc=args.nproc)#,gridfile="regional.grid",blkdat_file="blkdat.input")
@@ -8,6 +8,9 @@ import datetime
 import cfunits
 import netcdftime
 import scipy
+import threading
+import multiprocessing.pool
+import weakref
 import modeltools.tools
 
 # Set up logger
@@ -89,10 +92,60 @@ class AtmosphericForcingError(Exception):
 
 
 
+class _Recipe(object) :
+   """ Recipe for derived fields: func(af,*inputs) computes outputs from inputs. Inputs and outputs
+   are known names or intermediates. Intermediates (not in _all_known_names) are never kept as fields """
+   def __init__(self,outputs,inputs,func,units=None) :
+      self.outputs = outputs
+      self.inputs  = inputs
+      self.func    = func
+      self.units   = units
+
+   def unit(self,name) :
+      if self.units is not None :
+         return self.units[self.outputs.index(name)]
+      return _assumed_units[name]
+
+   def __call__(self,af,args,dtype=None) :
+      # If dtype is given, formulas are evaluated with inputs of that type
+      if dtype is not None :
+         args = [elem.astype(dtype,copy=False) for elem in args]
+      tmp = self.func(af,*args)
+      if len(self.outputs) == 1 :
+         tmp = (tmp,)
+      if dtype is not None :
+         tmp = tuple([elem.astype(dtype,copy=False) for elem in tmp])
+      return tmp
+
+
+def _ssrd_rosato(af,cc) :
+   lo,la = af["tcc"].grid
+   srad_top,cosz,cosz_noon =  qsw_et(af["tcc"].time,lo,la)
+   return qsw_allsky_rosato(srad_top,cosz,cosz_noon,cc),srad_top
+
+
+# Recipes for fields derived from other fields. If there are several recipes for a
+# field, the first one whose inputs are available is used.
+_derived_recipes = [
+      _Recipe(("satvap_2d",),    ("2d",),                           lambda af,t       : _satvap(t)),
+      _Recipe(("satvap_2t",),    ("2t",),                           lambda af,t       : _satvap(t)),
+      _Recipe(("wspd",),         ("10u","10v"),                     lambda af,u,v     : windspeed(u,v)),
+      _Recipe(("taux","tauy"),   ("10u","10v","wspd"),              lambda af,u,v,ws  : windstress(u,v,ws=ws)),
+      _Recipe(("ustar",),        ("taux","tauy"),                   lambda af,tx,ty   : numpy.sqrt((tx**2+ty**2)*1e-3)),
+      _Recipe(("vapmix",),       ("satvap_2d","msl"),               lambda af,e,p     : vapmix(e,p)),
+      _Recipe(("strd",),         ("2t","satvap_2d","tcc"),          lambda af,t,e,cc  : strd_efimova_jacobs(t,e,cc)),
+      _Recipe(("strd",),         ("2t","tcc"),                      lambda af,t,cc    : strd_maykut_jacobs(t,cc)),
+      _Recipe(("ssrd","sradtop"),("tcc",),                          _ssrd_rosato),
+      _Recipe(("relhum",),       ("satvap_2t","satvap_2d","msl"),   lambda af,e,ed,p  : relhumid(e,ed,p)/100.),
+      _Recipe(("slp",),          ("msl",),                          lambda af,p       : p*1e-2, units=(_assumed_units["msl"],)),
+      ]
+
+
+
 class AtmosphericForcing(object) :
    # These are the fileds this routine knows about, and can use to calculate new fields
 
-   def __init__(self,configfile,forcing_dataset,rootpath="") :
+   def __init__(self,configfile,forcing_dataset,rootpath="",prefetch=False,window=None) :
       self._configfile = configfile
       self._forcing_dataset=forcing_dataset
       self._tree=xml.etree.ElementTree.ElementTree(file=configfile)
@@ -153,27 +206,126 @@ class AtmosphericForcing(object) :
          self._fields[name] = modeltools.tools.ForcingFieldFromXml(xml_element,self._format,rootPath=self._rootPath,
                coord_props=coord_props)
 
+      # Prefetching of next time step in a background thread. The readers are only used by
+      # one thread at a time, this is ensured by _read_lock
+      self._read_lock     = threading.Lock()
+      self._prefetch      = prefetch
+      self._prefetch_pool = None
+      self._prefetched    = None
+
+      # Window mode: Read window time steps at a time, using slab reads of the input files
+      self._window       = window
+      self._window_times = None
+      self._window_last  = None
+
 
    def get_timestep(self,dt,varnames=None) :
+      """ Read fields at time dt. In prefetch mode, fields at dt + timestep are then read in the
+      background, and will be used by the next call to get_timestep if it asks for that time """
+      data = None
+      if self._prefetched is not None :
+         pdt,pvarnames,result = self._prefetched
+         self._prefetched = None
+         if pdt == dt and pvarnames == varnames :
+            data = result.get()
+         else :
+            logger.info("Discarding prefetched fields at %s"%str(pdt))
+            result.wait()
+      if data is None :
+         data = self._read_timestep(dt,varnames)
+
       for k,v in self._fields.items() :
          if varnames is None or k in varnames :
-            #if v.is_readable :
-            #   v.get_timestep(dt,unit=_assumed_units[k])
-            v.get_timestep(dt,unit=_assumed_units[k])
+            if k in data :
+               v.set_timestep(*data[k])
+            else :
+               # Derived fields (ForcingFieldCopy) are reset here
+               v.get_timestep(dt)
+
+      if self._prefetch :
+         if self._prefetch_pool is None :
+            self._prefetch_pool = multiprocessing.pool.ThreadPool(1)
+         nextdt = dt + self._timestep
+         self._prefetched = (nextdt,varnames,self._prefetch_pool.apply_async(self._read_timestep,(nextdt,varnames)))
+
+
+   def _read_timestep(self,dt,varnames) :
+      # Reads fields from file, without changing the fields themselves
+      data={}
+      with self._read_lock :
+         if self._window is not None and (self._window_times is None or
+               dt < self._window_times[0] or dt > self._window_times[1]) :
+            self._read_window(dt,varnames)
+         for k,v in self._fields.items() :
+            if v.is_readable and (varnames is None or k in varnames) :
+               data[k] = v.read_timestep(dt,unit=_assumed_units[k])
+               logger.info("Reading name %20s, varname=%20s"%(k,v.varname))
+      return data
+
+
+   def _read_window(self,dt,varnames) :
+      # Reads records of window time steps starting at dt into the fields
+      dts = [dt + i*self._timestep for i in range(self._window)]
+      if self._window_last is not None :
+         dts = [elem for elem in dts if elem <= self._window_last] or [dt]
+      for k,v in self._fields.items() :
+         if v.is_readable and (varnames is None or k in varnames) :
+            v.read_window(dts,unit=_assumed_units[k])
+      self._window_times = (dts[0],dts[-1])
+
+
+   def iter_timesteps(self,start,end,varnames=None) :
+      """ Generator reading fields at times from start to end (inclusive). Yields time of fields read.
+      In window mode, the windows are not read beyond end """
+      self._window_last = end
+      try :
+         dt = start
+         while dt <= end :
+            self.get_timestep(dt,varnames=varnames)
+            yield dt
+            dt = dt + self._timestep
+      finally :
+         self._window_last = None
+
+
+   def set_target_grid(self,plon,plat,halo=2) :
+      """ Only read the part of the input fields needed to interpolate to plon, plat (plus halo
+      points). Coordinates and grids of the fields are then those of the subset """
+      if self._prefetched is not None :
+         self._prefetched[2].wait()
+         self._prefetched = None
+      with self._read_lock :
+         for k,v in self._fields.items() :
+            if v.is_readable :
+               v.set_subset(plon,plat,halo=halo)
+         self._window_times = None
+
+
+   def close_prefetch(self) :
+      """ Stops prefetching of time steps and the background thread """
+      if self._prefetched is not None :
+         self._prefetched[2].wait()
+         self._prefetched = None
+      if self._prefetch_pool is not None :
+         self._prefetch_pool.close()
+         self._prefetch_pool.join()
+         self._prefetch_pool = None
 
 
    def get_grid(self,dt,varnames=None) :
       flddict={}
-      for k,v in self._fields.items() :
-         if varnames is None or k in varnames :
-            v.get_grid(dt)
+      with self._read_lock :
+         for k,v in self._fields.items() :
+            if varnames is None or k in varnames :
+               v.get_grid(dt)
 
 
    def get_coords(self,dt,varnames=None) :
       flddict={}
-      for k,v in self._fields.items() :
-         if varnames is None or k in varnames :
-            v.get_coords(dt)
+      with self._read_lock :
+         for k,v in self._fields.items() :
+            if varnames is None or k in varnames :
+               v.get_coords(dt)
 
 
 #   def get_proj4grid(self,dt,varnames=None) :
@@ -195,6 +347,14 @@ class AtmosphericForcing(object) :
    def timestep(self) :
       return self._timestep
 
+   @property
+   def prefetch(self) :
+      return self._prefetch
+
+   @property
+   def window(self) :
+      return self._window
+
    @property
    def timestep_in_days(self) :
       t=self.timestep
@@ -216,78 +376,91 @@ class AtmosphericForcing(object) :
       return [elem[0] for elem in self._fields.items() if elem[1].is_readable]
 
 
+   def _plan(self,names) :
+      # Returns recipes needed to compute names, in a valid order, and the field each derived
+      # field takes time, grid and coords from
+      available = [k for k,v in self._fields.items() if v.is_readable or v.data is not None]
+      template  = dict([(k,k) for k in available])
+      plan      = []
+      visiting  = set()
+
+      def resolve(name) :
+         if name in template :
+            return True
+         if name in visiting :
+            return False
+         visiting.add(name)
+         try :
+            for recipe in [elem for elem in _derived_recipes if name in elem.outputs] :
+               if all([resolve(elem) for elem in recipe.inputs]) :
+                  plan.append(recipe)
+                  for elem in recipe.outputs :
+                     template.setdefault(elem,template[recipe.inputs[0]])
+                  return True
+            return False
+         finally :
+            visiting.discard(name)
+
+      for name in names :
+         if not resolve(name) :
+            raise AtmosphericForcingError,"Can not calculate %s from available fields"%name
+      return plan,template
+
+
+   def calculate(self,names,dtype=None) :
+      """ Calculate derived fields names (known names), and the intermediate fields they need.
+      Each intermediate is computed once, and released as soon as no remaining recipe needs it.
+      Fields that are already available (read or calculated this time step) are not recalculated.
+      If dtype is given (ex numpy.float32), the fields are calculated with that precision """
+      plan,template = self._plan(names)
+
+      # Number of remaining uses of each computed value
+      nuses = {}
+      for recipe in plan :
+         for elem in recipe.inputs :
+            nuses[elem] = nuses.get(elem,0) + 1
+
+      values={}
+      for recipe in plan :
+         logger.info("Calculating %s from %s"%(",".join(recipe.outputs),",".join(recipe.inputs)))
+         args = [values[elem] if elem in values else self._fields[elem].data for elem in recipe.inputs]
+         for elem,data in zip(recipe.outputs,recipe(self,args,dtype=dtype)) :
+            if elem in names :
+               self._fields[elem] = modeltools.tools.ForcingFieldCopy(elem,self[template[elem]],recipe.unit(elem))
+               self[elem].set_data(data)
+            if elem in nuses :
+               values[elem] = data
+         del args
+         for elem in recipe.inputs :
+            nuses[elem] -= 1
+            if nuses[elem] == 0 and elem in values :
+               del values[elem]
+
+
    def calculate_windstress(self) :
-      logger.info("Calculating wind stress (taux, tauy) from wind fields")
-      if "10u" in self.known_names and "10v" in self.known_names :
-         self._fields["taux"] =  modeltools.tools.ForcingFieldCopy("taux",self["10u"],_assumed_units["taux"])
-         self._fields["tauy"] =  modeltools.tools.ForcingFieldCopy("tauy",self["10v"],_assumed_units["tauy"])
-         tmp1,tmp2 = windstress(self["10u"].data,self["10v"].data)
-         self["taux"].set_data(tmp1)
-         self["tauy"].set_data(tmp2)
-      else :
-         raise AtmosphericForcingError,"Can not calculate wind stress without 10 meter winds"
+      self.calculate(["taux","tauy"])
 
 
    def calculate_windspeed(self) :
-      logger.info("Calculating wind speed (wspd) from wind fields")
-      if "10u" in self.known_names and "10v" in self.known_names :
-         self._fields["wspd"]    = modeltools.tools.ForcingFieldCopy("wspd",self._fields["10u"],_assumed_units["wspd"])
-         self["wspd"].set_data(numpy.sqrt(self["10u"].data**2+self["10v"].data**2))
-      else :
-         raise AtmosphericForcingError,"Can not calculate wind speed without 10 meter winds"
+      self.calculate(["wspd"])
 
 
    def calculate_ustar(self) :
-      logger.info("Calculating ustar from taux, tauy")
-      if "taux" in self.known_names and "taux" in self.known_names :
-         self._fields["ustar"]    = modeltools.tools.ForcingFieldCopy("ustar",self["taux"],_assumed_units["ustar"])
-         self["ustar"].set_data(numpy.sqrt((self["taux"].data**2+self["tauy"].data**2)*1e-3))
-      else :
-         raise AtmosphericForcingError,"Can not calculate wind stress without 10 meter winds"
+      self.calculate(["ustar"])
 
 
    def calculate_vapmix(self) :
-      logger.info("Calculating vapmix")
-      if "msl" in self.known_names and "2d" in self.known_names:
-         e = satvap(self["2d"].data) 
-         self._fields["vapmix"]    = modeltools.tools.ForcingFieldCopy("vapmix",self["2t"],_assumed_units["vapmix"])
-         self["vapmix"].set_data(vapmix(e,self["msl"].data))
-      else :
-         raise AtmosphericForcingError,"Can not calculate wind stress without 10 meter winds"
+      self.calculate(["vapmix"])
      
      
    def calculate_strd(self) :
-      logger.info("Calculating strd")
       # Calculates downwelling longwave radiation
-      if "tcc" in self.known_names and "2t" in self.known_names and "2d" in self.known_names :
-         e = satvap(self["2d"].data)
-         self._fields["strd"]    = modeltools.tools.ForcingFieldCopy("strd",self["2d"],_assumed_units["strd"])
-         self._fields["strd"].set_data(strd_efimova_jacobs(self["2t"].data,e,self["tcc"].data))
-      # Estimate from surface parameters
-      elif "tcc" in self.known_names and "2t" in self.known_names :
-         self._fields["strd"]          = modeltools.tools.ForcingFieldCopy("strd",self["2t"],_assumed_units["strd"])
-         self["strd"].set_data(strd_maykut_jacobs(self["2t"].data,e,self["tcc"].data))
-      else :
-         raise AtmosphericForcingError,"Can not calculate TSRD"
+      self.calculate(["strd"])
 
      
    def calculate_ssrd(self) :
-      logger.info("Calculating ssrd")
-      # Calculates downwelling shortwave radiation
-      #if "ssrd" in self.known_names :
-      #   pass
-      ## Estimate from surface parameters
-      #elif "tcc" in self.known_names  :
-      if "tcc" in self.known_names  :
-         lo,la= self["tcc"].grid
-         srad_top,cosz,cosz_noon =  qsw_et(self["tcc"].time,lo,la)
-         ssrd =  qsw_allsky_rosato(srad_top,cosz,cosz_noon,self["tcc"].data) 
-         self._fields["ssrd"] = modeltools.tools.ForcingFieldCopy("ssrd",self["tcc"],_assumed_units["ssrd"])
-         self["ssrd"].set_data(ssrd)
-         self._fields["sradtop"] = modeltools.tools.ForcingFieldCopy("sradtop",self["tcc"],_assumed_units["sradtop"])
-         self["sradtop"].set_data(srad_top)
-      else :
-         raise AtmosphericForcingError,"Can not calculate SSRD"
+      # Calculates downwelling shortwave radiation (and top of atmosphere radiation sradtop)
+      self.calculate(["ssrd","sradtop"])
 
 
 #MOSTAFA: BEGIN
@@ -296,7 +469,7 @@ class AtmosphericForcing(object) :
       logger.info("Calculating nersc downwelling strd (Bignami 1995)")
       # Calculates downwelling longwave radiation
       if "tcc" in self.known_names and "2t" in self.known_names and "2d" in self.known_names :
-         e = satvap(self["2d"].data)
+         e = _satvap(self["2d"].data)
          self._fields["strd"]    = modeltools.tools.ForcingFieldCopy("strd",self["2d"],_assumed_units["strd"])
          self._fields["strd"].set_data(strd_bignami(self["2t"].data,e,self["tcc"].data))
       else :
@@ -307,7 +480,7 @@ class AtmosphericForcing(object) :
       logger.info("Calculating nersc downwelling strd (Budyko 1974)")
       # Calculates downwelling longwave radiation
       if "tcc" in self.known_names and "2t" in self.known_names and "2d" in self.known_names :
-         e = satvap(self["2d"].data)
+         e = _satvap(self["2d"].data)
          lo,la= self["tcc"].grid
          self._fields["lwrad"]    = modeltools.tools.ForcingFieldCopy("strd",self["2d"],_assumed_units["strd"])
          self._fields["lwrad"].set_data(lwrad_budyko(la,self["2t"].data,e,self["tcc"].data))
@@ -319,7 +492,7 @@ class AtmosphericForcing(object) :
       logger.info("Calculating downwelling lwrad (Berliand (1952)")
       # Calculates downwelling longwave radiation
       if "tcc" in self.known_names and "2t" in self.known_names and "2d" in self.known_names :
-         e = satvap(self["2d"].data)
+         e = _satvap(self["2d"].data)
          lo,la= self["tcc"].grid
          self._fields["lwrad"]    = modeltools.tools.ForcingFieldCopy("strd",self["2d"],_assumed_units["strd"])
          self._fields["lwrad"].set_data(lwrad_berliand(self["2t"].data,e,self["tcc"].data))
@@ -333,29 +506,22 @@ class AtmosphericForcing(object) :
 
 
    def calculate_slp(self) :
-      logger.info("Calculating slp")
-      if "msl" in self.known_names :
-         self._fields["slp"]    = modeltools.tools.ForcingFieldCopy("slp",self["msl"],_assumed_units["msl"])
-         self["slp"].set_data( self["msl"].data * 1e-2)
-      else :
-         raise AtmosphericForcingError,"Can not calculate slp fields"
+      self.calculate(["slp"])
 
 
    def calculate_relhum(self) :
-      logger.info("Calculating relhum")
-      if "2t" in self.known_names and "msl" in self.known_names and "2d" in self.known_names:
-         e = satvap(self["2t"].data)
-         ed= satvap(self["2d"].data)
-         #print self["2d"].data.max(),self["2t"].data.max(),self["msl"].data.max()
-         self._fields["relhum"]    = modeltools.tools.ForcingFieldCopy("relhum",self["2t"],_assumed_units["relhum"])
-         self["relhum"].set_data(relhumid(e,ed,self["msl"].data)/100.)
-      else :
-         raise AtmosphericForcingError,"Can not calculate wind stress without 10 meter winds"
+      self.calculate(["relhum"])
 
 
    @property
    def name(self) : return self._forcing_dataset
 
+   @property
+   def configfile(self) : return self._configfile
+
+   @property
+   def rootpath(self) : return self._rootPath
+
 
 
 
@@ -367,6 +533,7 @@ class ForcingProperty(object) :
       self._variable_unit   = variable_unit
       self._vector_info     = vector_info
       self._variable_limits = variable_limits
+      self._cfunit          = modeltools.tools.get_units(variable_unit)
 
    def apply_limit(self,data) :
       """ Apply specified limits to input data """
@@ -385,7 +552,7 @@ class ForcingProperty(object) :
 
    @property
    def cfunit(self) :
-      return cfunits.Units(self._variable_unit)
+      return self._cfunit
 
    @property
    def unit(self) :
@@ -413,7 +580,51 @@ class ForcingPropertySet(object) :
 
 
 
-      
+
+# Scratch arrays used by the flux formulas below, per thread. See _scratch
+_scratch_arrays = threading.local()
+
+def _scratch(name,shape,dtype) :
+   """ Returns scratch array called name, reused by subsequent calls with the same shape and dtype.
+   Only the latest array of each name is kept, so memory is bounded by one array per name """
+   if not hasattr(_scratch_arrays,"arrays") :
+      _scratch_arrays.arrays = {}
+   tmp = _scratch_arrays.arrays.get(name)
+   if tmp is None or tmp.shape <> shape or tmp.dtype <> numpy.dtype(dtype) :
+      tmp = numpy.empty(shape,dtype=dtype)
+      _scratch_arrays.arrays[name] = tmp
+   return tmp
+
+
+def _kernel_args(dtype,*args) :
+   """ Returns data of args as arrays (cast to dtype if given), the common shape and dtype,
+   and the combined mask of args (None if no arg is a masked array) """
+   data = [numpy.asarray(numpy.ma.getdata(elem),dtype=dtype) for elem in args]
+   shape = numpy.broadcast(*data).shape
+   if dtype is None :
+      # Same precision as numpy expressions on the arrays would give
+      arrays = [elem for elem in data if elem.ndim > 0]
+      dtype = numpy.result_type(*arrays) if arrays else numpy.float64
+      if not numpy.issubdtype(dtype,numpy.inexact) :
+         dtype = numpy.float64
+   mask = None
+   for elem in args :
+      if isinstance(elem,numpy.ma.MaskedArray) :
+         mask = numpy.ma.mask_or(numpy.ma.nomask if mask is None else mask,numpy.ma.getmask(elem))
+   return data,shape,dtype,mask
+
+
+def _kernel_out(out,shape,dtype,mask) :
+   """ Output array of kernel, and function wrapping the result as masked array if inputs were masked """
+   if out is None :
+      out = numpy.empty(shape,dtype=dtype)
+   def result(tmp) :
+      if mask is None :
+         return tmp
+      return numpy.ma.array(tmp,mask=mask,copy=False)
+   return out,result
+
+
 #MOSTAFA: BEGIN
 
 
@@ -453,26 +664,53 @@ def strd_bignami(tair,e,cc) :
    return strd
 
 
-def lwrad_budyko(lat,tair,e,cc) :
+def lwrad_budyko(lat,tair,e,cc,out=None,dtype=None) :
    # downwelling longwave radiation
    #tair : air temperature [K]
    #e    : near surface vapor pressure [Pa]
    #cc   : cloud cover (0-1)
-
-   et=611.*10.**(7.5*(tair-273.16)/(tair-35.86))
+   #out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
+
+   (lat,tair,e,cc),shape,dtype,mask = _kernel_args(dtype,lat,tair,e,cc)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   tmp1 = _scratch("lwrad_budyko1",shape,dtype)
+   tmp2 = _scratch("lwrad_budyko2",shape,dtype)
+   tmp3 = _scratch("lwrad_budyko3",shape,dtype)
+
+   # et=611.*10.**(7.5*(tair-273.16)/(tair-35.86))
+   numpy.subtract(tair,273.16,out=tmp1)
+   tmp1 *= 7.5
+   numpy.subtract(tair,35.86,out=tmp2)
+   tmp1 /= tmp2
+   numpy.power(10.,tmp1,out=tmp1)
+   tmp1 *= 611.
 #   print numpy.max(tair),numpy.max(et),numpy.max(e)
 #   exit(0)
    # Below formula assumes pressure in mBar
    emiss=0.97
    deg2rad = numpy.pi/180.
    # Clear sky downwelling longwave flux from Budyko(1961)
-   chi = 0.5+0.246*numpy.abs(lat*deg2rad)
-   cc_cliped=numpy.minimum(1.0,numpy.maximum(cc,0.))
-   term1=(0.254-4.95e-5*et)*(1.0-chi*cc_cliped**(1.2) )
-   strd = emiss*_stefanb * tair**4 * (term1)
-
-
-   return strd
+   # chi = 0.5+0.246*numpy.abs(lat*deg2rad)
+   numpy.multiply(lat,deg2rad,out=tmp2)
+   numpy.abs(tmp2,out=tmp2)
+   tmp2 *= 0.246
+   tmp2 += 0.5
+   # cc_cliped=numpy.minimum(1.0,numpy.maximum(cc,0.))
+   numpy.maximum(cc,0.,out=tmp3)
+   numpy.minimum(1.0,tmp3,out=tmp3)
+   # term1=(0.254-4.95e-5*et)*(1.0-chi*cc_cliped**(1.2) )
+   numpy.power(tmp3,1.2,out=tmp3)
+   tmp3 *= tmp2
+   numpy.subtract(1.0,tmp3,out=tmp3)
+   tmp1 *= 4.95e-5
+   numpy.subtract(0.254,tmp1,out=tmp1)
+   tmp1 *= tmp3
+   # strd = emiss*_stefanb * tair**4 * (term1)
+   numpy.power(tair,4,out=out)
+   out *= emiss*_stefanb
+   out *= tmp1
+
+   return result(out)
 
 
 #MOSTAFA: END
@@ -490,30 +728,40 @@ def lwrad_budyko(lat,tair,e,cc) :
 #      fqlww1=fqlw*tair*((.254-4.95e-5*vpair_w)*fqlwcc-4.)
 #      fqlww2=fqlwi2
 
-def strd_efimova_jacobs(tair,e,cc) :
+def strd_efimova_jacobs(tair,e,cc,out=None,dtype=None) :
    #tair : air temperature [K]
    #e    : near surface vapor pressure [Pa]
    #cc   : cloud cover (0-1)
+   #out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
+
+   (tair,e,cc),shape,dtype,mask = _kernel_args(dtype,tair,e,cc)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   tmp = _scratch("strd_efimova_jacobs",shape,dtype)
 
    # Below formula assumes pressure in mBar
-   e_mbar = e * 0.01
+   numpy.multiply(e,0.01,out=tmp)
 
    # Clear sky downwelling longwave flux from Eimova(1961)
-   strd = _stefanb * tair**4 * (0.746+0.0066*e_mbar) 
+   # strd = _stefanb * tair**4 * (0.746+0.0066*e_mbar) 
+   numpy.power(tair,4,out=out)
+   out *= _stefanb
+   tmp *= 0.0066
+   tmp += 0.746
+   out *= tmp
    
    # Cloud correction by Jacobs(1978)
-   strd = strd * (1. + 0.26 * cc) 
+   # strd = strd * (1. + 0.26 * cc) 
+   numpy.multiply(cc,0.26,out=tmp)
+   tmp += 1.
+   out *= tmp
 
-   return strd
+   return result(out)
 
    
 def strd_maykut_jacobs(tair,cc) :
    #tair : air temperature [K]
    #cc   : cloud cover (0-1)
 
-   # Below formula assumes pressure in mBar
-   e_mbar = e * 0.01
-
    # Clear sky downwelling longwave flux from Maykut and Church (1973). 
    strd = _stefanb * tair**4 * 0.7855
    
@@ -524,20 +772,59 @@ def strd_maykut_jacobs(tair,cc) :
 
 
 
-def windstress(uwind,vwind) :
+def windspeed(uwind,vwind,out=None,dtype=None) :
+   # Wind speed from wind components
+   # out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
+   (uwind,vwind),shape,dtype,mask = _kernel_args(dtype,uwind,vwind)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   tmp = _scratch("windspeed",shape,dtype)
+   numpy.multiply(uwind,uwind,out=out)
+   numpy.multiply(vwind,vwind,out=tmp)
+   out += tmp
+   numpy.sqrt(out,out=out)
+   return result(out)
+
+
+def windstress(uwind,vwind,ws=None,out=None,dtype=None) :
+   # ws is wind speed, calculated from uwind,vwind if not given
+   # out  : optional tuple of output arrays (taux,tauy). dtype: optional evaluation precision (ex numpy.float32)
    karalight=True
-   ws=numpy.sqrt(uwind**2+vwind**2)
-   if karalight :
-      wndfac=numpy.maximum(2.5,numpy.minimum(32.5,ws))
-      cd_new = 1.0E-3*(.692 + .0710*wndfac - .000700*wndfac**2)
-   else :
+   if not karalight :
+      if ws is None :
+         ws=numpy.sqrt(uwind**2+vwind**2)
       wndfac=(1.+sign(1.,ws-11.))*.5
       cd_new=(0.49+0.065*ws)*1.0e-3*wndfac+cd*(1.-wndfac)
-   wfact=ws*_airdns*cd_new
-   taux = uwind*wfact
-   tauy = vwind*wfact
-   ustar = numpy.sqrt((taux**2+tauy**2)*1e-3)
-   return taux, tauy
+      wfact=ws*_airdns*cd_new
+      return uwind*wfact, vwind*wfact
+
+   (uwind,vwind),shape,dtype,mask = _kernel_args(dtype,uwind,vwind)
+   if out is None :
+      out = (None,None)
+   taux,result = _kernel_out(out[0],shape,dtype,mask)
+   tauy,result = _kernel_out(out[1],shape,dtype,mask)
+   if ws is None :
+      ws = windspeed(uwind,vwind,out=_scratch("windstress_ws",shape,dtype))
+   else :
+      ws = numpy.asarray(numpy.ma.getdata(ws),dtype=dtype)
+   tmp1 = _scratch("windstress1",shape,dtype)
+   tmp2 = _scratch("windstress2",shape,dtype)
+
+   # wndfac=numpy.maximum(2.5,numpy.minimum(32.5,ws))
+   numpy.minimum(32.5,ws,out=tmp1)
+   numpy.maximum(2.5,tmp1,out=tmp1)
+   # cd_new = 1.0E-3*(.692 + .0710*wndfac - .000700*wndfac**2)
+   numpy.multiply(tmp1,tmp1,out=tmp2)
+   tmp2 *= .000700
+   tmp1 *= .0710
+   tmp1 += .692
+   tmp1 -= tmp2
+   tmp1 *= 1.0E-3
+   # wfact=ws*_airdns*cd_new
+   numpy.multiply(ws,_airdns,out=tmp2)
+   tmp2 *= tmp1
+   numpy.multiply(uwind,tmp2,out=taux)
+   numpy.multiply(vwind,tmp2,out=tauy)
+   return result(taux), result(tauy)
 
 
 
@@ -549,13 +836,14 @@ def vapmix(e,p) :
    return vapmix
 
 
-def satvap(t) :
+def satvap(t,out=None,dtype=None) :
    # This function calculates the saturation vapour pressure
    # [Pa] from the temperature [deg K].
    # Modified: Anita Jacob, June '97
    #
    # Input: t: temperature [deg K]
    # Output: satvap: saturation vapour pressure at temp. t
+   # out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
    #
    # es(T) = C1 * exp(C3*(T - T0)/(T - C4)) from ECMWF manual
    #data c1/610.78/,t00/273.16/
@@ -577,21 +865,126 @@ def satvap(t) :
    #c4 = numpy.where(t < t00,  7.66, 35.86)
 
    # From newest IFS (CY41R2)
-   c3 = numpy.where(t < t00, 22.587,17.502)
-   c4 = numpy.where(t < t00, -0.7  ,32.19)
-
-   aa = c3 * (t - t00)
-   bb = t - c4
-   cc=aa/bb
+   #c3 = numpy.where(t < t00, 22.587,17.502)
+   #c4 = numpy.where(t < t00, -0.7  ,32.19)
+   # Evaluated in double precision by default (as the float64 c3, c4 above gave)
+   if dtype is None :
+      dtype = numpy.float64
+   (t,),shape,dtype,mask = _kernel_args(dtype,t)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   below = _scratch("satvap_below",shape,bool)
+   tmp   = _scratch("satvap",shape,dtype)
+   numpy.less(t,t00,out=below)
+
+   # aa = c3 * (t - t00)
+   numpy.copyto(tmp,17.502)
+   numpy.copyto(tmp,22.587,where=below)
+   numpy.subtract(t,t00,out=out)
+   out *= tmp
+   # bb = t - c4
+   numpy.copyto(tmp,32.19)
+   numpy.copyto(tmp,-0.7,where=below)
+   numpy.subtract(t,tmp,out=tmp)
+   # cc=aa/bb
+   out /= tmp
 
    #if (cc < -20.0) then
    #   satvap=0.0
    #else
    #   satvap = c1 * exp(aa/bb)
-   satvap=numpy.where(cc<-20.0,0.0,c1 * numpy.exp(aa/bb))
-   return satvap
-
-def  relhumid(sva,svd,msl) :
+   #satvap=numpy.where(cc<-20.0,0.0,c1 * numpy.exp(aa/bb))
+   numpy.less(out,-20.0,out=below)
+   numpy.exp(out,out=out)
+   out *= c1
+   numpy.copyto(out,0.0,where=below)
+   return result(out)
+
+
+# Table used by satvap_table. Nodes are spaced by _satvap_table_step, with a node at t00=273.16 K
+# where the satvap coefficients change. Built on first use, see _satvap_table
+_satvap_table_t00   = 273.16
+_satvap_table_step  = 0.01
+_satvap_table_range = (173.16,373.16)
+_satvap_table_data  = None
+_satvap_table_lock  = threading.Lock()
+
+# Use satvap_table instead of satvap for derived fields. Disabled by default.
+_satvap_table_enabled = False
+
+def set_satvap_table(enabled=True) :
+   """ Enable/disable use of tabulated saturation vapour pressure (satvap_table) for derived fields """
+   global _satvap_table_enabled
+   _satvap_table_enabled = enabled
+
+
+def _satvap_table() :
+   """ Returns index of node t00, satvap at the table nodes and differences between consecutive nodes """
+   global _satvap_table_data
+   with _satvap_table_lock :
+      if _satvap_table_data is None :
+         k0 = int(round((_satvap_table_t00 - _satvap_table_range[0]) / _satvap_table_step))
+         k1 = int(round((_satvap_table_range[1] - _satvap_table_t00) / _satvap_table_step))
+         base = satvap(_satvap_table_t00 + numpy.arange(-k0,k1+1) * _satvap_table_step)
+         diff = numpy.zeros(base.shape)
+         diff[:-1] = base[1:] - base[:-1]
+         _satvap_table_data = (k0,base,diff)
+   return _satvap_table_data
+
+
+def satvap_table(t,out=None,dtype=None) :
+   # Saturation vapour pressure [Pa] from the temperature t [deg K], as satvap, but by
+   # linear interpolation in a table with spacing 0.01 K. Valid between 173.16 and 373.16 K,
+   # satvap is used for temperatures outside this range.
+   #
+   # Accuracy: the interpolation error relative to satvap is bounded by h**2/8 * (dln(es)/dT)**2
+   # with h=0.01 K. dln(es)/dT is below 0.21 K**-1 in the valid range, which gives a relative
+   # error below 6e-7 (below 2e-7 for T > 230 K). This is about 2 times faster than satvap.
+   # The table has a node at t00=273.16 K, where the coefficients of satvap change.
+   # out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
+   if dtype is None :
+      dtype = numpy.float64
+   (t,),shape,dtype,mask = _kernel_args(dtype,t)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   k0,base,diff = _satvap_table()
+
+   # x = fractional table index of t
+   x = _scratch("satvap_table_x",shape,numpy.float64)
+   numpy.subtract(t,_satvap_table_t00,out=x)
+   x *= 1./_satvap_table_step
+   x += k0
+   inside = _scratch("satvap_table_inside",shape,bool)
+   numpy.greater_equal(x,0.,out=inside)
+   inside &= x <= base.size-1
+   numpy.copyto(x,0.,where=~inside)
+
+   # es = base[k] + (x-k) * diff[k], with k = integer part of x
+   k = _scratch("satvap_table_k",shape,numpy.intp)
+   k[...] = x
+   x -= k
+   tmp = _scratch("satvap_table",shape,numpy.float64)
+   numpy.take(diff,k,out=tmp)
+   x *= tmp
+   numpy.take(base,k,out=tmp)
+   x += tmp
+   numpy.copyto(out,x,casting="unsafe")
+
+   # Temperatures outside table. Few points, so satvap is evaluated without scratch arrays
+   if not inside.all() :
+      outside = ~inside
+      tt = t[outside]
+      below = tt < _satvap_table_t00
+      tmp = numpy.where(below,22.587,17.502)*(tt-_satvap_table_t00)/(tt-numpy.where(below,-0.7,32.19))
+      out[outside] = numpy.where(tmp < -20.0,0.0,610.78*numpy.exp(tmp))
+   return result(out)
+
+
+def _satvap(t) :
+   # satvap or satvap_table, depending on set_satvap_table
+   if _satvap_table_enabled :
+      return satvap_table(t)
+   return satvap(t)
+
+def  relhumid(sva,svd,msl,out=None,dtype=None) :
    # This routine calculates the relative humidity by the 
    # dew point temperature and the mean sea level pressure.
    # Modified: Anita Jacob, June '97
@@ -599,6 +992,7 @@ def  relhumid(sva,svd,msl) :
    #    sva: saturatn vapour press at air temp [K]
    #    svd: saturatn vapour press at dew pt temp [K]
    #    msl: pressure at mean sea level [Pa]
+   #    out: optional output array. dtype: optional evaluation precision (ex numpy.float32)
    # Output: 
    #   relhumid: Relative Humidity
 
@@ -607,12 +1001,47 @@ def  relhumid(sva,svd,msl) :
    #              es(Tdew)        p - es(Tair)
    # RH = 100 *  -----------   *  ------------
    #             p - es(tdew)       es(Tair)
-   aaa=msl - svd
-   aaa = svd/aaa
-   bbb = (msl - sva)/sva
-   relhumid = 100. * aaa * bbb
-   return relhumid
-
+   (sva,svd,msl),shape,dtype,mask = _kernel_args(dtype,sva,svd,msl)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   tmp = _scratch("relhumid",shape,dtype)
+   # aaa = svd/(msl - svd)
+   numpy.subtract(msl,svd,out=out)
+   numpy.divide(svd,out,out=out)
+   # bbb = (msl - sva)/sva
+   numpy.subtract(msl,sva,out=tmp)
+   tmp /= sva
+   # relhumid = 100. * aaa * bbb
+   out *= 100.
+   out *= tmp
+   return result(out)
+
+
+
+# sin and cos of latitude and longitude in radians, per grid. See _grid_terms
+_grid_terms_cache = {}
+_grid_terms_lock  = threading.Lock()
+
+def _grid_terms(plon,plat) :
+   """ Returns plon in radians, sin and cos of plat in radians. Computed once for each pair of
+   read-only grid arrays (such as the grids of ForcingField), as long as they exist """
+   radian = numpy.pi/180.
+   readonly = [isinstance(elem,numpy.ndarray) and not elem.flags.writeable for elem in [plon,plat]]
+   if not all(readonly) :
+      tmp = plat*radian
+      return plon*radian,numpy.sin(tmp),numpy.cos(tmp)
+   key = (id(plon),id(plat))
+   with _grid_terms_lock :
+      if key in _grid_terms_cache :
+         lonref,latref,terms = _grid_terms_cache[key]
+         if lonref() is plon and latref() is plat :
+            return terms
+      tmp = plat*radian
+      terms = (plon*radian,numpy.sin(tmp),numpy.cos(tmp))
+      _grid_terms_cache[key] = (weakref.ref(plon),weakref.ref(plat),terms)
+      # Remove entries of grids that no longer exist
+      for k in [k for k,v in _grid_terms_cache.items() if v[0]() is None or v[1]() is None] :
+         del _grid_terms_cache[k]
+   return terms
 
 
 def qsw_et(dtime,plon,plat) :
@@ -622,28 +1051,45 @@ def qsw_et(dtime,plon,plat) :
    # CSIRO Division of Building Research
    # Melbourne, Victoria
    #
-   # dtime is datetime object
+   # dtime is datetime object, or a sequence of datetime objects. In the latter case
+   #       returned arrays have shape (ntime,)+plon.shape
    # plon in degrees
    # plat in degrees
    # NB: Only suitable for "present day climate"
 
    radian = numpy.pi/180.
 
-   tmp  = dtime-datetime.datetime(dtime.year,1,1,0,0,0)
-   tmp2 = datetime.datetime(dtime.year+1,1,1,0,0,0)-datetime.datetime(dtime.year,1,1,0,0,0)
-   tmp = tmp.days+tmp.seconds/86400.
-   tmp2 = tmp2.days+tmp2.seconds/86400.
-   logger.debug("Day of year - 31. dec of year: %.4f %.4f"%(tmp,tmp2))
-   dangle = 2*numpy.pi * float(tmp) / tmp2
-   hangle = dtime.hour/24. + dtime.minute/(24.*60.) + dtime.second/3600.
+   single = isinstance(dtime,datetime.datetime)
+   if single :
+      dtimes = [dtime]
+   else :
+      dtimes = list(dtime)
+
+   dangle = numpy.empty(len(dtimes))
+   hangle = numpy.empty(len(dtimes))
+   for i,elem in enumerate(dtimes) :
+      if abs(elem.year - 2000) > 3000. :
+         raise AtmosphericForcingError, "qsw_et only suitable for present day climate"
+      tmp  = elem-datetime.datetime(elem.year,1,1,0,0,0)
+      tmp2 = datetime.datetime(elem.year+1,1,1,0,0,0)-datetime.datetime(elem.year,1,1,0,0,0)
+      tmp = tmp.days+tmp.seconds/86400.
+      tmp2 = tmp2.days+tmp2.seconds/86400.
+      if single : logger.debug("Day of year - 31. dec of year: %.4f %.4f"%(tmp,tmp2))
+      dangle[i] = 2*numpy.pi * float(tmp) / tmp2
+      hangle[i] = elem.hour/24. + elem.minute/(24.*60.) + elem.second/3600.
    #hangle = numpy.mod(hangle-0.5,1.)*2*numpy.pi   # Solar hour angle, 0 at noon
    hangle = (hangle-0.5)*2*numpy.pi   # Solar hour angle, 0 at noon
 
-   logger.debug("day angle=%.4f"%dangle)
-   logger.debug("time hour angle at Greenwich=%.4f"%hangle)
-
-   if abs(dtime.year - 2000) > 3000. :
-      raise AtmosphericForcingError, "qsw_et only suitable for present day climate"
+   # Time dependent terms are scalars for a single time, and broadcast along first axis otherwise
+   if single :
+      dangle = dangle[0]
+      hangle = hangle[0]
+      logger.debug("day angle=%.4f"%dangle)
+      logger.debug("time hour angle at Greenwich=%.4f"%hangle)
+   else :
+      shape = (len(dtimes),)+(1,)*numpy.ndim(plat)
+      dangle.shape = shape
+      hangle.shape = shape
 
 
    # Solar declination in radians
@@ -662,43 +1108,70 @@ def qsw_et(dtime,plon,plat) :
    # eot indicates offset from UT time. Negative means that UT time is faster than  solar time
    hangle = hangle + eot
 
+   # Grid dependent terms, computed once per grid
+   plonrad,sinlat,coslat = _grid_terms(plon,plat)
+
    # Local solar hour angle
-   loc_hangle=hangle+plon*radian
+   loc_hangle=hangle+plonrad
 
    # Solar Zenith angle
-   cosz_noon = numpy.sin(plat*radian)*numpy.sin(decli) + numpy.cos(plat*radian)*numpy.cos(decli)
-   cosz      = numpy.sin(plat*radian)*numpy.sin(decli) + numpy.cos(plat*radian)*numpy.cos(decli)*numpy.cos(loc_hangle)
+   tmp       = sinlat*numpy.sin(decli)
+   cosz_noon = tmp + coslat*numpy.cos(decli)
+   cosz      = tmp + coslat*numpy.cos(decli)*numpy.cos(loc_hangle)
 
    cosz     =numpy.maximum(0.,numpy.minimum(1.,cosz     ))
    cosz_noon=numpy.maximum(0.,numpy.minimum(1.,cosz_noon))
 
    srad =_s0*cosz
 
-   logger.debug("declination in degrees      : %.4f"%(decli*180./numpy.pi))
-   logger.debug("equation of time  in degrees: %.4f"%(eot*180./numpy.pi))
-   logger.debug("equation of time  in minutes: %.3f"%(1440 * eot/(2*numpy.pi)))
-   #logger.debug("Zenith at solar noon        : ",numpy.arccos(cosz)*180./numpy.pi)
-   logger.debug("time hour angle at Greenwich, corrected for eot=%.4f"%hangle)
+   if single :
+      logger.debug("declination in degrees      : %.4f"%(decli*180./numpy.pi))
+      logger.debug("equation of time  in degrees: %.4f"%(eot*180./numpy.pi))
+      logger.debug("equation of time  in minutes: %.3f"%(1440 * eot/(2*numpy.pi)))
+      #logger.debug("Zenith at solar noon        : ",numpy.arccos(cosz)*180./numpy.pi)
+      logger.debug("time hour angle at Greenwich, corrected for eot=%.4f"%hangle)
 
    return srad,cosz,cosz_noon
 
 
-def qsw_allsky_rosato(srad_top,cosz,cosz_noon,cc) :
+def qsw_allsky_rosato(srad_top,cosz,cosz_noon,cc,out=None,dtype=None) :
    # Follows Rosato and Miyakoda[1988]
    # srad = cloud-top incident radiation
    # cosz = cosine of solar zenith angle
+   # out  : optional output array. dtype: optional evaluation precision (ex numpy.float32)
+   (srad_top,cosz,cosz_noon,cc),shape,dtype,mask = _kernel_args(dtype,srad_top,cosz,cosz_noon,cc)
+   out,result = _kernel_out(out,shape,dtype,mask)
+   tmp1 = _scratch("qsw_allsky_rosato1",shape,dtype)
+   tmp2 = _scratch("qsw_allsky_rosato2",shape,dtype)
 
    # direct component
-   sdir=srad_top*0.7**(1./(cosz+1e-2))     #direct radiation component
-   sdif=((1.-_absh2o)*srad_top-sdir)*.5        #diffusive radiation component
+   # sdir=srad_top*0.7**(1./(cosz+1e-2))     #direct radiation component
+   numpy.add(cosz,1e-2,out=out)
+   numpy.divide(1.,out,out=out)
+   numpy.power(0.7,out,out=out)
+   out *= srad_top
+   # sdif=((1.-_absh2o)*srad_top-sdir)*.5        #diffusive radiation component
+   numpy.multiply(srad_top,1.-_absh2o,out=tmp1)
+   tmp1 -= out
+   tmp1 *= .5
+   out  += tmp1
 
    # Solar altitude
-   altdeg=numpy.maximum(0.,numpy.arcsin(cosz_noon))*180./numpy.pi #solar noon altitude in degrees
+   # altdeg=numpy.maximum(0.,numpy.arcsin(cosz_noon))*180./numpy.pi #solar noon altitude in degrees
+   numpy.arcsin(cosz_noon,out=tmp1)
+   numpy.maximum(0.,tmp1,out=tmp1)
+   tmp1 *= 180.
+   tmp1 /= numpy.pi
 
-   cfac=(1.-0.62*cc+0.0019*altdeg)               #cloudiness correction by Reed(1977)
-   ssurf=(sdir+sdif)*cfac
+   # cfac=(1.-0.62*cc+0.0019*altdeg)               #cloudiness correction by Reed(1977)
+   numpy.multiply(cc,0.62,out=tmp2)
+   numpy.subtract(1.,tmp2,out=tmp2)
+   tmp1 *= 0.0019
+   tmp2 += tmp1
+   # ssurf=(sdir+sdif)*cfac
+   out *= tmp2
 
-   return ssurf
+   return result(out)
 
 
 
@@ -708,13 +1181,17 @@ def qsw_allsky_rosato(srad_top,cosz,cosz_noon,cc) :
 
 
 
-def qsw0(qswtime,daysinyear,cc,plat,plon) :
+def qsw0(qswtime,daysinyear,cc,plat,plon,diurnal=False,chunksize=6) :
    #
    # --- -------------------------------------------------------------------
    # --- compute 24 hrs mean solar irrradiance at the marine surface layer
    # --- (unit: w/m^2)
    # --- -------------------------------------------------------------------
    #
+   # --- The ifrac parts of the day are evaluated chunksize parts at a time, along a
+   # --- new first array axis. If diurnal is True, the irradiance of each part is also
+   # --- returned, as array of shape (ifrac,)+plat.shape (parts of first 12 hrs, see below)
+   #
    # --- Average number of days in year over a 400-year cycle (Gregorian Calendar)
    daysinyear400=365.2425
    #c --- set various quantities
@@ -727,6 +1204,10 @@ def qsw0(qswtime,daysinyear,cc,plat,plon) :
    absh2o=0.09              # ---    absorption of water and ozone
    s0=1365.                 # w/m^2  solar constant
    radian=rad
+#
+# --- Masks of cc and plat are carried over to the results, see end of routine
+   platmask=numpy.ma.getmask(plat)
+   (cc,plat),shape,dtype,mask=_kernel_args(None,cc,plat)
 #c
 #c --- -------------------------------------------------------------------
 #c --- compute 24 hrs mean solar radiation at the marine surface layer 
@@ -760,29 +1241,52 @@ def qsw0(qswtime,daysinyear,cc,plat,plon) :
 # --- the (24 hrs) day (mean for the first 12 hrs equals then the mean
 # --- for the last 12 hrs)
 #
-# --- TODO - This routine can also return daily varying solar heat flux
-   scosz=0.
-   stot=0.
-   for npart in range(1,25) :
-      bioday=day+(npart-.5)*fraci*.5
-      biohr=bioday*86400.                #hour of day in seconds
-      biohr=numpy.mod(biohr+43200.,86400.)    #hour of day;  biohr=0  at noon
-      hangle=pi2*biohr/86400.            #hour angle, in radians
+# --- Terms not depending on the part of the day
+   altdeg=numpy.maximum(0.,numpy.arcsin(numpy.minimum(1.0,sin2+cos2)))*deg #solar noon altitude in degrees
+   cfac=(1.-0.62*cc+0.0019*altdeg)               #cloudiness correction 
+   shape=numpy.broadcast(sin2,cos2,cfac).shape
+   sin2=numpy.broadcast_to(sin2,shape)
+   cos2=numpy.broadcast_to(cos2,shape)
+   cfac=numpy.broadcast_to(cfac,shape)
+
+# --- hour angle of each part
+   npart=numpy.arange(1,ifrac+1)
+   bioday=day+(npart-.5)*fraci*.5
+   biohr=bioday*86400.                #hour of day in seconds
+   biohr=numpy.mod(biohr+43200.,86400.)    #hour of day;  biohr=0  at noon
+   hangle=pi2*biohr/86400.            #hour angle, in radians
+   coshangle=numpy.cos(hangle)
+
+   scosz=numpy.zeros(shape)
+   stot =numpy.zeros(shape)
+   if diurnal :
+      sparts=numpy.empty((ifrac,)+shape)
+   for i0 in range(0,ifrac,chunksize) :
+      i1 = min(i0+chunksize,ifrac)
+      tmp = coshangle[i0:i1].reshape((i1-i0,)+(1,)*len(shape))
 #
-      cosz=numpy.maximum(0.,sin2+cos2*numpy.cos(hangle)) #cosine of the zenith angle
-      scosz=scosz+cosz                     #  ..accumulated..
+      cosz=numpy.maximum(0.,sin2+cos2*tmp) #cosine of the zenith angle
+      scosz+=cosz.sum(axis=0)              #  ..accumulated..
       srad =s0*sundv*cosz                  #extraterrestrial radiation
 #
 #         sdir=srad*0.7**(1./(cosz+eepsil))    #direct radiation component
 #         sdir=srad * exp(-0.356674943938732447/(cosz+eepsil))         
 # ---    KAL prevent underflow - .7^100 = 3x10^-16 
-      sdir=srad*0.7**(numpy.minimum(100.,1./(cosz+eepsil)))    #direct radiation component
+      cosz+=eepsil
+      numpy.divide(1.,cosz,out=cosz)
+      numpy.minimum(100.,cosz,out=cosz)
+      sdir=numpy.power(0.7,cosz,out=cosz)
+      sdir*=srad                                    #direct radiation component
 #
-      sdif=((1.-absh2o)*srad-sdir)*.5               #diffusive radiation component
-      altdeg=numpy.maximum(0.,numpy.arcsin(numpy.minimum(1.0,sin2+cos2)))*deg #solar noon altitude in degrees
-      cfac=(1.-0.62*cc+0.0019*altdeg)               #cloudiness correction 
-      ssurf=(sdir+sdif)*cfac
-      stot=stot+ssurf
+#     sdif=((1.-absh2o)*srad-sdir)*.5               #diffusive radiation component
+#     ssurf=(sdir+sdif)*cfac
+      srad*=(1.-absh2o)*.5
+      sdir*=.5
+      srad+=sdir
+      srad*=cfac
+      stot+=srad.sum(axis=0)
+      if diurnal :
+         sparts[i0:i1]=srad
 
 #     enddo
    scosz=scosz*fraci               #24-hrs mean of  cosz
@@ -799,6 +1303,16 @@ def qsw0(qswtime,daysinyear,cc,plat,plon) :
 #
 #     end subroutine qsw0
 
+   if mask is not None :
+      mask=numpy.array(numpy.broadcast_to(mask,shape))
+      radfl0=numpy.ma.array(radfl0,mask=mask,copy=False)
+      if diurnal :
+         sparts=numpy.ma.array(sparts,mask=numpy.array(numpy.broadcast_to(mask,sparts.shape)),copy=False)
+   if platmask is not numpy.ma.nomask :
+      cawdir=numpy.ma.array(cawdir,mask=numpy.array(numpy.broadcast_to(platmask,cawdir.shape)),copy=False)
+
+   if diurnal :
+      return radfl0,cawdir,sparts
    return radfl0,cawdir
 
 
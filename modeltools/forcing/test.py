@@ -0,0 +1,214 @@
+import unittest
+import timeit
+import numpy
+import modeltools.forcing.atmosphere
+import modeltools.tools
+
+class SatvapTableTest(unittest.TestCase):
+    tmin=173.16
+    tmax=373.16
+    maxrelerr=6e-7
+
+    def test_accuracy(self):
+       t=numpy.linspace(self.tmin,self.tmax,2000001)
+       e1=modeltools.forcing.atmosphere.satvap(t)
+       e2=modeltools.forcing.atmosphere.satvap_table(t)
+       relerr=numpy.abs(e2-e1)/e1
+       print "satvap_table max relative error:",relerr.max()
+       self.assertTrue(relerr.max() < self.maxrelerr)
+
+    def test_outside_table(self):
+       t=numpy.array([100.,self.tmin-1.,self.tmax+1.,400.])
+       e1=modeltools.forcing.atmosphere.satvap(t)
+       e2=modeltools.forcing.atmosphere.satvap_table(t)
+       self.assertTrue(numpy.all(e1==e2))
+
+       # Points outside table do not use or add scratch arrays
+       t=numpy.random.uniform(250.,300.,(10,10))
+       modeltools.forcing.atmosphere.satvap(t)
+       modeltools.forcing.atmosphere.satvap_table(t)
+       scratch=dict(modeltools.forcing.atmosphere._scratch_arrays.arrays)
+       for n in range(1,20) :
+          t=numpy.random.uniform(250.,300.,(10,10))
+          t.flat[:n]=400.
+          e=modeltools.forcing.atmosphere.satvap_table(t)
+          self.assertTrue(numpy.all(e.flat[:n]==modeltools.forcing.atmosphere.satvap(t).flat[:n]))
+       for k,v in modeltools.forcing.atmosphere._scratch_arrays.arrays.items() :
+          self.assertTrue(scratch[k] is v)
+
+    def test_masked(self):
+       t=numpy.ma.array([250.,280.,290.],mask=[False,True,False])
+       e=modeltools.forcing.atmosphere.satvap_table(t)
+       self.assertTrue(isinstance(e,numpy.ma.MaskedArray))
+       self.failUnlessEqual(list(numpy.ma.getmaskarray(e)),[False,True,False])
+
+    def test_benchmark(self):
+       t=numpy.random.uniform(230.,310.,(500,500))
+       out=numpy.empty(t.shape)
+       t1=min(timeit.repeat(lambda : modeltools.forcing.atmosphere.satvap(t,out=out),number=10,repeat=3))
+       t2=min(timeit.repeat(lambda : modeltools.forcing.atmosphere.satvap_table(t,out=out),number=10,repeat=3))
+       print "satvap: %.4f s, satvap_table: %.4f s (10 calls on %dx%d grid)"%(t1,t2,t.shape[0],t.shape[1])
+
+
+class LongwaveSatvapTest(unittest.TestCase):
+
+    def write_dataset(self):
+       # Forcing dataset with fields 2t, 2d and tcc in one netCDF file
+       import netCDF4
+       modeltools.tools.netcdf_dataset_pool.close_all()
+       nc=netCDF4.Dataset("test_forcing.nc","w")
+       nc.createDimension("time",None)
+       nc.createDimension("latitude",6)
+       nc.createDimension("longitude",8)
+       var=nc.createVariable("time","f8",("time",))
+       var.units="hours since 2000-01-01 00:00:00"
+       var.calendar="standard"
+       var[:]=[0.,6.]
+       var=nc.createVariable("latitude","f8",("latitude",))
+       var.units="degrees_north"
+       var[:]=numpy.linspace(50.,75.,6)
+       var=nc.createVariable("longitude","f8",("longitude",))
+       var.units="degrees_east"
+       var[:]=numpy.linspace(0.,35.,8)
+       for varname,low,high in [("T2",260.,300.),("D2",250.,260.),("TCC",0.,1.)] :
+          var=nc.createVariable(varname,"f8",("time","latitude","longitude"))
+          var.units="1"
+          var[:]=numpy.random.uniform(low,high,(2,6,8))
+       nc.close()
+       open("test_forcing.xml","w").write("""<?xml version="1.0"?>
+<xml>
+   <forcing_datasets>
+      <forcing_dataset name="test" rootPath="." format="netcdf" timestep="6h">
+         <field known_name="2t"  file="test_forcing.nc" varname="T2"  units="K"/>
+         <field known_name="2d"  file="test_forcing.nc" varname="D2"  units="K"/>
+         <field known_name="tcc" file="test_forcing.nc" varname="TCC" units="1"/>
+      </forcing_dataset>
+   </forcing_datasets>
+</xml>
+""")
+
+    def test_satvap_table(self):
+       import datetime
+       atm=modeltools.forcing.atmosphere
+       self.write_dataset()
+       af=atm.AtmosphericForcing("test_forcing.xml","test")
+       af.get_timestep(datetime.datetime(2000,1,1,6))
+       t,d,cc=af["2t"].data,af["2d"].data,af["tcc"].data
+       la=af["tcc"].grid[1]
+       for enabled,func in [(False,atm.satvap),(True,atm.satvap_table)] :
+          atm.set_satvap_table(enabled)
+          try :
+             af.calculate_strd_bignami()
+             self.assertTrue(numpy.all(af["strd"].data==atm.strd_bignami(t,func(d),cc)))
+             af.calculate_lwrad_budyko()
+             self.assertTrue(numpy.all(af["lwrad"].data==atm.lwrad_budyko(la,t,func(d),cc)))
+             af.calculate_lwrad_berliand()
+             self.assertTrue(numpy.all(af["lwrad"].data==atm.lwrad_berliand(t,func(d),cc)))
+          finally :
+             atm.set_satvap_table(False)
+       self.assertFalse(numpy.all(atm.satvap(d)==atm.satvap_table(d)))
+
+
+class AtmforTest(unittest.TestCase):
+
+    def load_script(self):
+       # hycom_atmfor is a script, not part of the package. It needs abfile
+       import imp
+       import os
+       try :
+          import abfile
+       except ImportError :
+          self.skipTest("abfile not installed")
+       return imp.load_source("hycom_atmfor",
+             os.path.join(os.path.dirname(modeltools.__file__),"_old","scripts","hycom_atmfor.py"))
+
+    def test_ordered_results(self):
+       import multiprocessing.pool
+       import threading
+       import time
+       hycom_atmfor=self.load_script()
+       slices=[[2*k,2*k+1] for k in range(10)]
+       maxpending=3
+       lock=threading.Lock()
+       started=[0]
+
+       # Later slices finish first
+       def process(dts) :
+          with lock : started[0]+=1
+          time.sleep(0.005*(20-dts[0]))
+          return [10*dt for dt in dts]
+
+       pool=multiprocessing.pool.ThreadPool(4)
+       try :
+          results=[]
+          for res in hycom_atmfor._ordered_results(pool,process,slices,maxpending) :
+             self.assertTrue(started[0] <= len(results)+maxpending)
+             results.append(res)
+       finally :
+          pool.terminate()
+          pool.join()
+       self.failUnlessEqual(results,[[10*dt for dt in dts] for dts in slices])
+
+
+class ScratchTest(unittest.TestCase):
+
+    def test_bounded(self):
+       atm=modeltools.forcing.atmosphere
+       atm.windstress(numpy.ones((5,5)),numpy.ones((5,5)))
+       nscratch=len(atm._scratch_arrays.arrays)
+       for n in range(10,60) :
+          u=numpy.random.rand(n,n)
+          taux,tauy=atm.windstress(u,u)
+       self.failUnlessEqual(len(atm._scratch_arrays.arrays),nscratch)
+       self.assertTrue(numpy.all(taux==atm.windstress(u,u)[0]))
+
+
+def qsw0_loop(qswtime,daysinyear,cc,plat) :
+    # Reference: qsw0 as a loop over the parts of the day
+    pi2=8.*numpy.arctan(1.)
+    deg=360./pi2
+    rad=pi2/360.
+    day=numpy.floor(numpy.mod(qswtime,daysinyear))
+    dangle=pi2*day/float(daysinyear)
+    decli=.006918+.070257*numpy.sin(dangle)   -.399912*numpy.cos(dangle)      \
+                 +.000907*numpy.sin(2.*dangle)-.006758*numpy.cos(2.*dangle)   \
+                 +.001480*numpy.sin(3.*dangle)-.002697*numpy.cos(3.*dangle)
+    sundv=1.00011+.001280*numpy.sin(dangle)   +.034221*numpy.cos(dangle)      \
+                 +.000077*numpy.sin(2.*dangle)+.000719*numpy.cos(2.*dangle)
+    sin2=numpy.sin(plat*rad)*numpy.sin(decli)
+    cos2=numpy.cos(plat*rad)*numpy.cos(decli)
+    scosz=0.
+    stot=0.
+    for npart in range(1,25) :
+       biohr=numpy.mod((day+(npart-.5)/24.*.5)*86400.+43200.,86400.)
+       cosz=numpy.maximum(0.,sin2+cos2*numpy.cos(pi2*biohr/86400.))
+       scosz=scosz+cosz
+       srad=1365.*sundv*cosz
+       sdir=srad*0.7**(numpy.minimum(100.,1./(cosz+1.e-9)))
+       sdif=((1.-0.09)*srad-sdir)*.5
+       altdeg=numpy.maximum(0.,numpy.arcsin(numpy.minimum(1.0,sin2+cos2)))*deg
+       stot=stot+(sdir+sdif)*(1.-0.62*cc+0.0019*altdeg)
+    return stot/24.,1.-numpy.minimum(0.15,0.05/(scosz/24.+0.15))
+
+
+class Qsw0Test(unittest.TestCase):
+
+    def test_masked_cc(self):
+       plat,plon=numpy.meshgrid(numpy.linspace(-80.,80.,9),numpy.linspace(0.,350.,8))
+       data=numpy.random.rand(*plat.shape)
+       data[0,0]=1e20
+       cc=numpy.ma.masked_greater(data,1.)
+       radfl0,cawdir=modeltools.forcing.atmosphere.qsw0(100.,365,cc,plat,plon)
+       radfl1,cawdir1=qsw0_loop(100.,365,cc,plat)
+       self.assertTrue(isinstance(radfl0,numpy.ma.MaskedArray))
+       self.assertTrue(numpy.all(numpy.ma.getmaskarray(radfl0) == numpy.ma.getmaskarray(radfl1)))
+       self.assertTrue(numpy.ma.allclose(radfl0,radfl1,rtol=1e-12,atol=0.))
+       self.assertTrue(numpy.allclose(cawdir,cawdir1,rtol=1e-12,atol=0.))
+
+       # Parts of the day are masked as the mean
+       radfl0,cawdir,sparts=modeltools.forcing.atmosphere.qsw0(100.,365,cc,plat,plon,diurnal=True)
+       self.assertTrue(numpy.all(sparts.mask[:,0,0]))
+       self.assertFalse(numpy.any(sparts.mask[:,1:,:]))
+
+if __name__ == "__main__" :
+   unittest.main()
@@ -1,9 +1,15 @@
 """ MNodule for doing IO on files used by hycom """
 import numpy 
-import struct
 import sys
+import os
 import logging
 import re
+import multiprocessing
+import multiprocessing.pool
+import threading
+import json
+import hashlib
+import collections
 
 # Set up logger
 _loglevel=logging.INFO
@@ -26,10 +32,33 @@ class BFileError(Exception) :
    pass
 
 
+# Cache of parsed .b file field info (see ABFile.load_field_info). Disabled by default.
+# When enabled, the index is stored as json next to the .b file, or in _index_cache_dir if set.
+_index_cache_enabled = False
+_index_cache_dir     = None
+
+def set_index_cache(enabled=True,cachedir=None) :
+   """ Enable/disable caching of parsed .b file field info. If cachedir is None, the
+   index is stored next to the .b file (as <basename>.b.idx) """
+   global _index_cache_enabled, _index_cache_dir
+   _index_cache_enabled = enabled
+   _index_cache_dir     = cachedir
+
+
+def _decode_field_info(fields) :
+   # Field info as read from a json index: Record numbers back to int, strings back to str
+   res={}
+   for i,d in fields.items() :
+      res[int(i)] = dict([(str(k),str(v) if isinstance(v,unicode) else v) for k,v in d.items()])
+   return res
+
+
 class AFile(object) :
    """ Class for doing binary input/output on hycom .a files """
    _huge = 2.0**100
-   def __init__(self,idm,jdm,filename,action,mask=False,real4=True,endian="big") :
+   _write_chunksize = 2**20 # Approximate number of values processed at a time in writerecord
+   def __init__(self,idm,jdm,filename,action,mask=False,real4=True,endian="big",memmap=False,
+         dtype=numpy.float64) :
       self._idm = idm
       self._jdm = jdm 
       self._filename = filename 
@@ -37,8 +66,12 @@ class AFile(object) :
       self._mask = mask 
       self._real4= real4
       self._endian= endian
-      if self._action.lower() not in ["r","w"]  :
-         raise AFileError("action argument must be either r(ead) or w(rite)")
+      self._memmap = memmap
+      self._dtype = numpy.dtype(dtype).newbyteorder("=") # Type of arrays returned by reads
+      if self._action.lower() not in ["r","w","r+"]  :
+         raise AFileError("action argument must be either r(ead), w(rite) or r+ (update)")
+      if self._memmap and self._action.lower() <> "r" :
+         raise AFileError("memmap only supported when action is r(ead)")
       if self._endian.lower() not in ["little","big","native"]  :
          raise AFileError("action argument must be either native, little ort big")
 
@@ -51,6 +84,12 @@ class AFile(object) :
       else :
          self._endian_structfmt = "<"
 
+      # numpy type of data on file (ex >f4), used to decode records directly from disk
+      if self._real4 :
+         self._file_dtype = numpy.dtype("%sf4"%self._endian_structfmt)
+      else :
+         self._file_dtype = numpy.dtype("%sf8"%self._endian_structfmt)
+
       logging.debug("Endianness set to %s",self._endian)
 
 
@@ -72,76 +111,230 @@ class AFile(object) :
       # Open .a and .b file
       self._filea = open(self._filename,self._action+"b")
 
+      # Map the whole file as (nrec,n2drec). Pages are only read from disk when accessed
+      if self._memmap :
+         nrec = os.path.getsize(self._filename) // (self.n2drec*self._file_dtype.itemsize)
+         if nrec == 0 :
+            raise AFileError("File %s does not contain a full record"%self._filename)
+         self._mmap = numpy.memmap(self._filename,dtype=self._file_dtype,mode="r",
+               shape=(nrec,self.n2drec))
+      else :
+         self._mmap = None
+
 
 
    def writerecord(self,h,mask,record=None) :
+      """ Write h to file. If record is given, the record with that number is (over)written,
+      otherwise h is written at the current position. Returns min and max of unmasked h
 
-      # Initialize writing array (1D)
-      w=numpy.ones(self._n2drec)*self._spval
+      The record is processed in blocks of rows (about _write_chunksize values), so masked
+      min/max, masking and conversion to the file type need memory for one block only. """
 
       # Check array shape against idm/jdm
       if h.shape[0] <> self._jdm or h.shape[1] <> self._idm :
          raise AFileError,"array shape is (%d,%d),expected (%d,%d)"%(h.shape[0],h.shape[1],self._jdm,self._idm)
 
-      # Fill w array
-      w[0:self._idm*self._jdm] = h.flatten() 
+      if self._action.lower() == "r" :
+         raise AFileError("File %s not opened for writing"%self._filename)
+
+      logger.info("zaiowr_a h shape = %s, w.size=%d"%(h.shape,self._n2drec,))
 
-      # Seek to array, but this is not supported yet
+      # Seek to record if specified
       if record is not None :
-         raise AFileError("Seeked writes not yet supported")
+         self.seekrecord(record)
 
-      logger.info("zaiowr_a h shape = %s, w.size=%d"%(h.shape,w.size,))
-      # Calc min and mask
-      if self._mask :
-         I=numpy.where(~mask)
-         hmax=h[I].max()
-         hmin=h[I].min()
-         J=numpy.where(mask.flatten())
-         w[J] = self._spval
-      else :
-         hmax=h.max()
-         hmin=h.min()
+      # Block buffer in file type. Conversion and byte swapping is done on assignment
+      nrows = max(1,min(self._jdm,self._write_chunksize//self._idm))
+      w=numpy.empty(max(nrows*self._idm,self._n2drec-self._idm*self._jdm),dtype=self._file_dtype)
 
-      if self._real4 :
-         struct_fmt="f"
-      else :
-         struct_fmt="d"
-      binpack=struct.pack("%s%d%s"%(self._endian_structfmt,w.size,struct_fmt),*w[:])
-      self._filea.write(binpack)
+      # Scratch buffer used for masked min/max
+      if self._mask :
+         scratch=numpy.empty(nrows*self._idm,dtype=numpy.promote_types(h.dtype,numpy.float32))
+
+      hmin,hmax = numpy.inf,-numpy.inf
+      for j0 in range(0,self._jdm,nrows) :
+         j1 = min(self._jdm,j0+nrows)
+         m  = (j1-j0)*self._idm
+         hc = numpy.ravel(h[j0:j1,:])
+         w[0:m] = hc
+
+         # Calc min and mask
+         if self._mask :
+            mc = numpy.ravel(mask[j0:j1,:])
+            sc = scratch[0:m]
+            sc[:] = hc
+            numpy.putmask(sc,mc,numpy.inf)
+            hmin=min(hmin,sc.min())
+            numpy.putmask(sc,mc,-numpy.inf)
+            hmax=max(hmax,sc.max())
+            numpy.putmask(w[0:m],mc,self._spval)
+         else :
+            hmin=min(hmin,hc.min())
+            hmax=max(hmax,hc.max())
+
+         w[0:m].tofile(self._filea)
+
+      # Pad record to n2drec
+      npad = self._n2drec-self._idm*self._jdm
+      w[0:npad] = self._spval
+      w[0:npad].tofile(self._filea)
+
+      # All points masked
+      if hmin > hmax :
+         hmin,hmax = self._spval,self._spval
       return hmin,hmax
 
 
-   def readrecord(self,record) :
+   def readrecord(self,record,masked=True,dtype=None) :
+      """ Read record number "record" from file, returns a (jdm,idm) array.
 
-      # Seek to correct record and read
-      self.seekrecord(record)
-      if self._real4 :
-         raw = self._filea.read(self.n2drec*4)
-         fmt =  "%s%df"%(self._endian_structfmt,self.n2drec)
-      else :
-         raw = self._filea.read(self.n2drec*8)
-         fmt =  "%s%dd"%(self._endian_structfmt,self.n2drec)
+      The record is decoded directly from file into an array of the file type (ex >f4). It
+      is then converted to dtype in native byte order (no copy if the types already match).
+      If dtype is None, the dtype given when opening the file is used. If masked is True,
+      values above huge are masked, otherwise a plain ndarray is returned. """
+
+      w=self._raw_record(record).astype(self._native_dtype(dtype),copy=False)
+
+      # Full (jdm,idm) mask, also when no values are masked
+      if masked :
+         w=numpy.ma.MaskedArray(w,mask=w>self._huge*.5,copy=False)
+
+      return w
 
-      w =  numpy.array(struct.unpack(fmt,raw))
-      w=numpy.ma.masked_where(w>self._huge*.5,w)
 
+
+   def _raw_record(self,record) :
+      # (jdm,idm) array of record in the file type. View into the memory map if memmap=True
+      if self._mmap is not None :
+         return self.record_view(record)
+      # Seek to correct record and read
+      self.seekrecord(record)
+      w = numpy.fromfile(self._filea,dtype=self._file_dtype,count=self.n2drec)
+      if w.size <> self.n2drec :
+         raise AFileError("Could only read %d of %d values in record %d of %s"%(
+            w.size,self.n2drec,record,self._filename))
       w=w[0:self.idm*self.jdm]
       w.shape=(self.jdm,self.idm)
-
       return w
 
 
+   def iter_tiles(self,record,rows=256,masked=True,dtype=None) :
+      """ Iterate over record in blocks of rows. Yields (j0,j1,block) where block is the
+      (j1-j0,idm) part of the record. Each block is decoded directly from file, so the
+      full record is never held in memory. Arguments masked and dtype are as in readrecord. """
+      dtype=self._native_dtype(dtype)
+      offset = record*self.n2drec*self._file_dtype.itemsize
+      for j0 in range(0,self.jdm,rows) :
+         j1 = min(self.jdm,j0+rows)
+         if self._mmap is not None :
+            w = self.record_view(record)[j0:j1,:]
+         else :
+            self._filea.seek(offset+j0*self.idm*self._file_dtype.itemsize)
+            w = numpy.fromfile(self._filea,dtype=self._file_dtype,count=(j1-j0)*self.idm)
+            if w.size <> (j1-j0)*self.idm :
+               raise AFileError("Could only read %d of %d values in rows %d-%d of record %d of %s"%(
+                  w.size,(j1-j0)*self.idm,j0,j1,record,self._filename))
+            w.shape=(j1-j0,self.idm)
+         w=w.astype(dtype,copy=False)
+         if masked :
+            w=numpy.ma.MaskedArray(w,mask=w>self._huge*.5,copy=False)
+         yield j0,j1,w
+
+
+   def readrecords(self,records,masked=True,dtype=None,nthreads=None) :
+      """ Read a list of records into a stacked (nrec,jdm,idm) array using a pool of threads.
+
+      Each thread decodes its records with its own file handle, opened once when the thread
+      starts (or from the memory map), directly into the output array. nthreads defaults to
+      the number of cores. Arguments masked and dtype are as in readrecord. """
+      out = numpy.empty((len(records),self.jdm,self.idm),dtype=self._native_dtype(dtype))
+      if masked :
+         outmask = numpy.empty(out.shape,dtype=bool)
+
+      # File handles of the reading threads
+      local = threading.local()
+      handles = []
+      def open_handle() :
+         if self._mmap is None :
+            local.fid = open(self._filename,"rb")
+            handles.append(local.fid)
+
+      def read_one(i) :
+         if self._mmap is not None :
+            w = self.record_view(records[i])
+         else :
+            local.fid.seek(records[i]*self.n2drec*self._file_dtype.itemsize)
+            w = numpy.fromfile(local.fid,dtype=self._file_dtype,count=self.idm*self.jdm)
+            if w.size <> self.idm*self.jdm :
+               raise AFileError("Could only read %d of %d values in record %d of %s"%(
+                  w.size,self.idm*self.jdm,records[i],self._filename))
+            w.shape=(self.jdm,self.idm)
+         out[i] = w
+         if masked :
+            numpy.greater(out[i],self._huge*.5,out=outmask[i])
+
+      if nthreads is None :
+         nthreads = multiprocessing.cpu_count()
+      nthreads = max(1,min(nthreads,len(records)))
+      try :
+         if nthreads == 1 :
+            open_handle()
+            for i in range(len(records)) : read_one(i)
+         else :
+            pool = multiprocessing.pool.ThreadPool(nthreads,open_handle)
+            try :
+               pool.map(read_one,range(len(records)))
+            finally :
+               pool.close()
+               pool.join()
+      finally :
+         for fid in handles : fid.close()
+
+      if masked :
+         out = numpy.ma.MaskedArray(out,mask=outmask,copy=False)
+      return out
+
+
+   def record_view(self,record) :
+      """ Returns a lazy (jdm,idm) view of record in the file type. Needs memmap=True.
+
+      No data is read until the view is accessed, and only the pages touched are read.
+      Values above huge are not masked. """
+      if self._mmap is None :
+         raise AFileError("record_view needs file opened with memmap=True")
+      if record < 0 or record >= self._mmap.shape[0] :
+         raise AFileError("Record %d outside file %s with %d records"%(
+            record,self._filename,self._mmap.shape[0]))
+      return self._mmap[record,0:self.idm*self.jdm].reshape((self.jdm,self.idm))
+
+
+   def __getitem__(self,key) :
+      """ afile[record] or afile[record,j0:j1,i0:i1]. Returns raw values in the file type
+      (including byte order, ex >f4). Values above huge are not masked.
+
+      Lazy view into the file if opened with memmap=True, otherwise the record is read. """
+      if isinstance(key,tuple) :
+         record,index = key[0],key[1:]
+      else :
+         record,index = key,()
+      return self._raw_record(record)[index]
+
+
+   def _native_dtype(self,dtype) :
+      if dtype is None :
+         return self._dtype
+      else :
+         return numpy.dtype(dtype).newbyteorder("=")
+
 
    def seekrecord(self,record) :
       # Seek to correct record and read
-      if self._real4 :
-         self._filea.seek(record*self.n2drec*4)
-      else :
-         self._filea.seek(record*self.n2drec*8)
+      self._filea.seek(record*self.n2drec*self._file_dtype.itemsize)
       return
 
 
    def close(self) :
+      self._mmap = None
       self._filea.close()
 
 
@@ -150,6 +343,26 @@ class AFile(object) :
       return self._n2drec
 
 
+   @property
+   def dtype(self):
+      """ Type of arrays returned by reads """
+      return self._dtype
+
+
+   @property
+   def file_dtype(self):
+      """ Type of data on file (ex >f4) """
+      return self._file_dtype
+
+
+   @property
+   def nrec(self):
+      """ Number of complete records in file (memmap mode only) """
+      if self._mmap is None :
+         raise AFileError("nrec needs file opened with memmap=True")
+      return self._mmap.shape[0]
+
+
    @property
    def idm(self):
       return self._idm
@@ -165,7 +378,7 @@ class AFile(object) :
 class ABFile(object) :
    """ Class for doing binary input/output on hycom .b files """
 
-   def __init__(self,basename,action,mask=False,real4=True,endian="big") :
+   def __init__(self,basename,action,mask=False,real4=True,endian="big",dtype=numpy.float64) :
       self._basename=basename
       self._action=action
       self._fileb = open(self._basename+".b",self._action)
@@ -173,6 +386,7 @@ class ABFile(object) :
       self._mask = mask
       self._real4 = real4
       self._endian = endian
+      self._dtype = dtype
       self._firstwrite=True
 
    def close(self) :
@@ -213,6 +427,96 @@ class ABFile(object) :
    def fieldnames(self) :
       return set([elem["field"] for elem in self._fields.values()])
 
+   def load_field_info(self) :
+      """ Sets field info from the index cache if it is valid for the .b file. Otherwise
+      the .b file is parsed (read_field_info), and the index stored if caching is enabled """
+      fields = None
+      if _index_cache_enabled :
+         indexfile = self._index_filename()
+         st = os.stat(self._basename+".b")
+         key = (self.__class__.__name__,st.st_size,st.st_mtime)
+         try :
+            fid = open(indexfile,"r")
+            try :
+               tmp = json.load(fid)
+            finally :
+               fid.close()
+            if tmp["key"] == list(key) :
+               fields = _decode_field_info(tmp["fields"])
+               logger.debug("Field info of %s.b read from %s"%(self._basename,indexfile))
+         except (IOError,OSError,ValueError,KeyError,TypeError,AttributeError) :
+            pass
+
+      if fields is not None :
+         self._fields = fields
+      else :
+         self.read_field_info()
+         if _index_cache_enabled :
+            self._write_index(indexfile,key)
+      self._build_record_index()
+
+
+   def _index_filename(self) :
+      if _index_cache_dir is None :
+         return self._basename+".b.idx"
+      else :
+         tmp = hashlib.sha1(os.path.abspath(self._basename+".b")).hexdigest()
+         return os.path.join(_index_cache_dir,tmp+".idx")
+
+
+   def _write_index(self,indexfile,key) :
+      # Write to temporary file and rename, so that other processes never see a partial index
+      tmpfile = "%s.%d"%(indexfile,os.getpid())
+      try :
+         if _index_cache_dir is not None and not os.path.isdir(_index_cache_dir) :
+            os.makedirs(_index_cache_dir)
+         fid = open(tmpfile,"w")
+         try :
+            json.dump({"key":key,"fields":self._fields},fid)
+         finally :
+            fid.close()
+         os.rename(tmpfile,indexfile)
+      except (IOError,OSError) :
+         logger.debug("Could not write index file %s"%indexfile)
+
+
+   def _build_record_index(self) :
+      # Maps (field,level) to record number. (field,None) maps to the last record of field
+      self._record_index={}
+      self._has_levels=False
+      for i in sorted(self._fields.keys()) :
+         d = self._fields[i]
+         self._record_index[(d["field"],None)] = i
+         if "k" in d :
+            self._record_index[(d["field"],d["k"])] = i
+            self._has_levels=True
+
+
+   def _record_of(self,fieldname,level=None) :
+      """ Returns record number of fieldname (at level, if the file has levels), or None """
+      if level is not None and (fieldname,level) in self._record_index :
+         return self._record_index[(fieldname,level)]
+      elif level is None or not self._has_levels :
+         return self._record_index.get((fieldname,None))
+      else :
+         return None
+
+   def read_fields(self,fields,masked=True,dtype=None,nthreads=None) :
+      """ Read a list of fields into a stacked (nrec,jdm,idm) array. Elements of fields are
+      either field names or (fieldname,level) tuples. Records are read in parallel, see
+      AFile.readrecords """
+      records=[]
+      for elem in fields :
+         if isinstance(elem,tuple) :
+            fieldname,level = elem
+         else :
+            fieldname,level = elem,None
+         record = self._record_of(fieldname,level)
+         if record is None :
+            raise BFileError("Field %s at level %s not in %s.b"%(fieldname,str(level),self._basename))
+         records.append(record)
+      return self._filea.readrecords(records,masked=masked,dtype=dtype,nthreads=nthreads)
+
    def write_field(*args,**kwargs) :
    #def write_field(self,field,mask,fieldname,fmt="%16.8g") :
       #hmin,hmax = self._filea.zaiowr_a(field,mask)
@@ -238,7 +542,7 @@ class ABFile(object) :
       if self._filea is None :
          self._jdm,self._idm = field.shape
          self._filea = AFile(self._idm,self._jdm,self._basename+".a",
-               self._action,mask=self._mask,real4=self._real4,endian=self._endian)
+               self._action,mask=self._mask,real4=self._real4,endian=self._endian,dtype=self._dtype)
       else :
          pass
 
@@ -249,14 +553,15 @@ class ABFile(object) :
 
 
 class ABFileBathy(ABFile) :
-   def __init__(self,basename,action,mask=False,real4=True,endian="big",idm=None,jdm=None) :
+   def __init__(self,basename,action,mask=False,real4=True,endian="big",idm=None,jdm=None,
+         dtype=numpy.float64) :
 
-      super(ABFileBathy,self).__init__(basename,action,mask=mask,real4=real4,endian=endian)
+      super(ABFileBathy,self).__init__(basename,action,mask=mask,real4=real4,endian=endian,dtype=dtype)
       if action == "r" and idm <> None and jdm <> None:
          self._idm=idm
          self._jdm=jdm
          self.read_header()
-         self.read_field_info()
+         self.load_field_info()
          self._open_filea_if_necessary(numpy.zeros((jdm,idm)))
       else :
          self.write_header()
@@ -311,10 +616,7 @@ class ABFileBathy(ABFile) :
    def read_field(self,fieldname,mask) :
       print self._fields
       """ Read field corresponding to fieldname and level from bathy file"""
-      record = None
-      for i,d in self._fields.items() :
-         if d["field"] == fieldname :
-            record=i
+      record = self._record_of(fieldname)
       if record  is not None :
          w = self._filea.readrecord(record) 
       else :
@@ -323,12 +625,9 @@ class ABFileBathy(ABFile) :
 
 
    def bminmax(self,fieldname) :
-      record=None
-      for i,d in self._fields.items() :
-         if d["field"] == fieldname :
-            record=i
+      record = self._record_of(fieldname)
       if record  is not None :
-         ret = (self._fields[i]["min"],self._fields[i]["max"])
+         ret = (self._fields[record]["min"],self._fields[record]["max"])
       else :
          ret = (None,None)
       return ret
@@ -337,16 +636,17 @@ class ABFileBathy(ABFile) :
 
 class ABFileGrid(ABFile) :
    fieldkeys=["min","max"]
-   def __init__(self,basename,action,mask=False,real4=True,endian="big",mapflg=-1) :
+   def __init__(self,basename,action,mask=False,real4=True,endian="big",mapflg=-1,
+         dtype=numpy.float64) :
 
-      super(ABFileGrid,self).__init__(basename,action,mask=mask,real4=real4,endian=endian)
+      super(ABFileGrid,self).__init__(basename,action,mask=mask,real4=real4,endian=endian,dtype=dtype)
       self._mapflg=mapflg
 
       if action == "w" :
          pass
       else :
          self.read_header()
-         self.read_field_info()
+         self.load_field_info()
          self._open_filea_if_necessary(numpy.zeros((self._jdm,self._idm)))
 
    def read_header(self) :
@@ -381,10 +681,7 @@ class ABFileGrid(ABFile) :
 
    def read_field(self,fieldname) :
       """ Read field corresponding to fieldname and level from archive file"""
-      record = None
-      for i,d in self._fields.items() :
-         if d["field"] == fieldname :
-            record=i
+      record = self._record_of(fieldname)
       if record  is not None :
          w = self._filea.readrecord(record) 
       else :
@@ -406,86 +703,67 @@ class ABFileGrid(ABFile) :
 
 
 
-#class ABFileArchv(BFile) :
-#   fieldkeys=["field","step","day","k","dens","min","max"]
-#   def __init__(self,basename,action,mask=False,real4=True,endian="big",
-#         iversn=None,iexpt=None,yrflag=None,idm=None,jdm=None) :
-#
-#      self._action  = action  
-#      self._mask    = mask
-#      self._real4   = real4
-#      self._endian  = endian
-#      self._iversn  = iversn
-#      self._iexpt   = iexpt
-#      self._yrflag  = yrflag
-#      self._idm     = idm
-#      self._jdm     = jdm
-#
-#      if self._action == "r" :
-#         super(ABFileArchv,self).__init__(basename+".b","r")
-#         self._read_header() # Sets internal metadata. Overrides those on input
-#         self._read_field_info()
-#      elif self._action == "w" :
-#         # Need to test if idm, jdm, etc is set at this stage
-#         raise NotImplementedError,"ABFileArchv writing not implemented"
-#         super(ABFileArchv,self).__init__(basename+".b",self._action)
-#
-#      self._filea = AFile(self._idm,self._jdm,basename+".a",self._action,mask=self._mask,real4=self._real4,endian=self._endian)
-#
-#
-#
-#   def _read_header(self) :
-#      self._header=[]
-#      self._header.append(self.readline())
-#      self._header.append(self.readline())
-#      self._header.append(self.readline())
-#      self._header.append(self.readline())
-#
-#      item,self._iversn = self.scanitem(item="iversn",conversion=int)
-#      item,self._iexpt  = self.scanitem(item="iexpt",conversion=int)
-#      item,self._yrflag = self.scanitem(item="yrflag",conversion=int)
-#      item,self._idm    = self.scanitem(item="idm",conversion=int)
-#      item,self._jdm    = self.scanitem(item="jdm",conversion=int)
-#
-#   def _read_field_info(self) :
-#      # Get list of fields from .b file
-#      #field       time step  model day  k  dens        min              max
-#      #montg1   =      67392    351.000  1 25.000   0.0000000E+00   0.0000000E+00
-#      #
-#      self._fields={}
-#      line=self.readline()
-#      line=self.readline().strip()
-#      i=0
-#      while line :
-#         elems = re.split("[ =]+",line)
-#         self._fields[i] = dict(zip(self.fieldkeys,[el.strip() for el in elems]))
-#         for k in self.fieldkeys :
-#            if k in ["min","max","dens","day"] :
-#               self._fields[i][k] = float(self._fields[i][k])
-#            elif k in ["k","step"] :
-#               self._fields[i][k] = int(self._fields[i][k])
-#         i+=1
-#         line=self.readline().strip()
-#
-#
-#   def readfield(self,fieldname,level) :
-#      """ Read field corresponding to fieldname and level from archive file"""
-#      record = None
-#      for i,d in self._fields.items() :
-#         if d["field"] == fieldname and level == d["k"] :
-#            record=i
-#      if record  is not None :
-#         w = self.readrecord(record) 
-#      else :
-#         w = None
-#      return w
-#
-#
-#
-#
-#   @property
-#   def levels(self) :
-#      return set([elem["k"] for elem in self._fields.values()])
+class ABFileArchv(ABFile) :
+   """ Read only access to hycom archive files """
+   fieldkeys=["field","step","day","k","dens","min","max"]
+   def __init__(self,basename,action="r",mask=False,real4=True,endian="big",dtype=numpy.float64) :
+
+      if action <> "r" :
+         raise BFileError,"ABFileArchv can only be opened for reading"
+      super(ABFileArchv,self).__init__(basename,action,mask=mask,real4=real4,endian=endian,dtype=dtype)
+
+      self.read_header() # Sets internal metadata
+      self.load_field_info()
+      self._open_filea_if_necessary(numpy.zeros((self._jdm,self._idm)))
+
+
+   def read_header(self) :
+      self._header=[]
+      self._header.append(self.readline())
+      self._header.append(self.readline())
+      self._header.append(self.readline())
+      self._header.append(self.readline())
+
+      item,self._iversn = self.scanitem(item="iversn",conversion=int)
+      item,self._iexpt  = self.scanitem(item="iexpt",conversion=int)
+      item,self._yrflag = self.scanitem(item="yrflag",conversion=int)
+      item,self._idm    = self.scanitem(item="idm",conversion=int)
+      item,self._jdm    = self.scanitem(item="jdm",conversion=int)
+
+   def read_field_info(self) :
+      # Get list of fields from .b file
+      #field       time step  model day  k  dens        min              max
+      #montg1   =      67392    351.000  1 25.000   0.0000000E+00   0.0000000E+00
+      #
+      self._fields={}
+      line=self.readline()
+      line=self.readline().strip()
+      i=0
+      while line :
+         elems = re.split("[ =]+",line)
+         self._fields[i] = dict(zip(self.fieldkeys,[el.strip() for el in elems]))
+         for k in self.fieldkeys :
+            if k in ["min","max","dens","day"] :
+               self._fields[i][k] = float(self._fields[i][k])
+            elif k in ["k","step"] :
+               self._fields[i][k] = int(self._fields[i][k])
+         i+=1
+         line=self.readline().strip()
+
+
+   def read_field(self,fieldname,level) :
+      """ Read field corresponding to fieldname and level from archive file"""
+      record = self._record_of(fieldname,level)
+      if record  is not None :
+         w = self._filea.readrecord(record) 
+      else :
+         w = None
+      return w
+
+
+   @property
+   def fieldlevels(self) :
+      return set([elem["k"] for elem in self._fields.values()])
       
       
 #class ABFileForcing(BFile) :
@@ -622,19 +900,132 @@ def write_regional_grid(grid,endian="big") :
 
    regf.close()
 
-def read_regional_grid(endian="big") :
+_regional_grid_fields = ["plon","plat","qlon","qlat","ulon","ulat",
+      "vlon","vlat","pang","scpx","scpy","scqx","scqy",
+      "scux","scuy","scvx","scvy","cori","pasp"]
+
+def read_regional_grid(endian="big",cache=False,cachedir="regional.grid.cache") :
+   """ Read fields of regional.grid. If cache is True, decoded fields are stored as .npy
+   files in cachedir, and later calls read them from there as long as regional.grid.[ab]
+   are unchanged (same size and mtime). Cached fields are stored with the precision of
+   regional.grid.a, and returned as the same writable float64 masked arrays (with full
+   masks) as uncached reads """
+   if cache :
+      key = []
+      for ext in [".a",".b"] :
+         st = os.stat("regional.grid"+ext)
+         key.extend([st.st_size,st.st_mtime])
+      key = (endian,numpy.array(key,dtype=numpy.float64))
+      res = _read_grid_cache(cachedir,key)
+      if res is not None :
+         return res
+
    regf = ABFileGrid("regional.grid","r",endian=endian)
    res={}
-   for fld in ["plon","plat","qlon","qlat","ulon","ulat",
-         "vlon","vlat","pang","scpx","scpy","scqx","scqy",
-         "scux","scuy","scvx","scvy","cori","pasp"] :
+   for fld in _regional_grid_fields :
       print fld
       res[fld] = regf.read_field(fld)
+   file_dtype = regf._filea.file_dtype
    regf.close()
 
+   if cache :
+      _write_grid_cache(cachedir,key,res,file_dtype.newbyteorder("="))
+
+   return res
+
+
+def _read_grid_cache(cachedir,key) :
+   # Files are read with allow_pickle=False, so a cache directory writable by others can
+   # not be used to run code
+   try :
+      tmp = numpy.load(os.path.join(cachedir,"key.npz"),allow_pickle=False)
+      try :
+         if str(tmp["endian"]) <> key[0] or not numpy.array_equal(tmp["stat"],key[1]) :
+            return None
+      finally :
+         tmp.close()
+      res={}
+      for fld in _regional_grid_fields :
+         data = numpy.load(os.path.join(cachedir,fld+".npy"),allow_pickle=False).astype(numpy.float64)
+         maskfile = os.path.join(cachedir,fld+".mask.npy")
+         if os.path.exists(maskfile) :
+            mask = numpy.load(maskfile,allow_pickle=False)
+         else :
+            mask = numpy.zeros(data.shape,dtype=bool)
+         res[fld] = numpy.ma.MaskedArray(data,mask=mask,copy=False)
+   except (IOError,OSError,KeyError,ValueError) :
+      return None
+   logger.info("Grid fields read from cache in %s"%cachedir)
    return res
 
 
+def _write_grid_cache(cachedir,key,res,dtype) :
+   # Fields are written as dtype to temporary files and renamed. The key is written last
+   tag = ".%d.tmp"%os.getpid()
+   try :
+      if not os.path.isdir(cachedir) :
+         os.makedirs(cachedir)
+      keyfile = os.path.join(cachedir,"key.npz")
+      if os.path.exists(keyfile) :
+         os.remove(keyfile)
+      for fld in _regional_grid_fields :
+         data = numpy.ma.getdata(res[fld]).astype(dtype,copy=False)
+         for name,arr in [(fld,data),(fld+".mask",numpy.ma.getmask(res[fld]))] :
+            filename = os.path.join(cachedir,name+".npy")
+            if arr is numpy.ma.nomask or (name.endswith(".mask") and not arr.any()) :
+               if os.path.exists(filename) : os.remove(filename)
+               continue
+            fid = open(filename+tag,"wb")
+            try :
+               numpy.save(fid,arr)
+            finally :
+               fid.close()
+            os.rename(filename+tag,filename)
+      fid = open(keyfile+tag,"wb")
+      try :
+         numpy.savez(fid,endian=numpy.array(key[0]),stat=key[1])
+      finally :
+         fid.close()
+      os.rename(keyfile+tag,keyfile)
+   except (IOError,OSError) :
+      logger.warning("Could not write grid cache in %s"%cachedir)
+
+
+
+def iter_fields_prefetched(basenames,fields,abclass=ABFileArchv,depth=2,nthreads=1,**kwargs) :
+   """ Iterate over AB files in the order given, yielding (basename,data) where data is the
+   stacked array of fields returned by read_fields.
+
+   The fields of the next depth files are read by background threads while the caller works
+   on the current one, so at most depth+1 sets of fields are held in memory. nthreads is
+   passed to read_fields, other keyword arguments to abclass """
+
+   def read(basename) :
+      ab = abclass(basename,"r",**kwargs)
+      try :
+         return ab.read_fields(fields,nthreads=nthreads)
+      finally :
+         ab.close()
+
+   basenames = list(basenames)
+   depth = max(1,depth)
+   pool = multiprocessing.pool.ThreadPool(depth)
+   pending = collections.deque()
+   try :
+      inext = 0
+      for basename in basenames :
+         # Keep the current file and up to depth files ahead in flight
+         while inext < len(basenames) and len(pending) < depth+1 :
+            pending.append(pool.apply_async(read,(basenames[inext],)))
+            inext += 1
+         data = pending.popleft().get()
+         yield basename,data
+         data = None
+   finally :
+      pool.terminate()
+      pool.join()
+
+
 
 #def write_newpos(grid) :
 #   #logging.debug("Endianness set to %s",endian)
@@ -4,6 +4,7 @@ import unittest
 import random
 import numpy
 import modeltools.hycom
+import modeltools.hycom.old.hycom_io
 
 class TimeTest(unittest.TestCase):
 
@@ -75,6 +76,314 @@ class HycomIOTest(unittest.TestCase) :
          unittest.fail("AFile IO failed. MAx diff between read/written: %14.7g"%max([maxdiff1,maxdiff2,maxdiff3]))
       #print "end"
 
+   def test_afile_read_dtype(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld=numpy.random.rand(jdm,idm)
+      mask=wfld > 0.9
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w",mask=True)
+      afile.writerecord(wfld,mask)
+      afile.close()
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r")
+      rfld1=afile.readrecord(0)
+      rfld2=afile.readrecord(0,masked=False,dtype=numpy.float32)
+      afile.close()
+
+      self.assertEqual(rfld1.dtype,numpy.float64)
+      self.assertTrue(numpy.all(rfld1.mask == mask))
+      self.assertEqual(rfld2.dtype,numpy.float32)
+      self.assertFalse(isinstance(rfld2,numpy.ma.MaskedArray))
+      self.assertTrue(numpy.all(rfld2[mask] > 1e29))
+      self.assertTrue(numpy.all(rfld2[~mask] == wfld[~mask].astype(numpy.float32)))
+
+   def test_afile_memmap(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld1=numpy.random.rand(jdm,idm)
+      wfld2=numpy.random.rand(jdm,idm)
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w")
+      afile.writerecord(wfld1,None)
+      afile.writerecord(wfld2,None)
+      afile.close()
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r",memmap=True)
+      self.assertEqual(afile.nrec,2)
+      self.assertEqual(afile[1].shape,(jdm,idm))
+      self.assertTrue(numpy.all(afile[1,2:5,3:7] == wfld2[2:5,3:7].astype(numpy.float32)))
+      self.assertTrue(numpy.all(afile.readrecord(0) == wfld1.astype(numpy.float32)))
+      afile.close()
+
+      # Without memmap, __getitem__ also returns values in the file type
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r")
+      self.assertEqual(afile[1].dtype,afile.file_dtype)
+      self.assertTrue(numpy.all(afile[1,2:5,3:7] == wfld2[2:5,3:7].astype(numpy.float32)))
+      afile.close()
+
+   def test_afile_seeked_write(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld1=numpy.random.rand(jdm,idm)
+      wfld2=numpy.random.rand(jdm,idm)
+      wfld3=numpy.random.rand(jdm,idm)
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w")
+      afile.writerecord(wfld1,None)
+      afile.writerecord(wfld2,None)
+      afile.close()
+
+      # Patch first record in place
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r+")
+      afile.writerecord(wfld3,None,record=0)
+      afile.close()
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r")
+      rfld1=afile.readrecord(0)
+      rfld2=afile.readrecord(1)
+      afile.close()
+      self.assertTrue(numpy.all(rfld1 == wfld3.astype(numpy.float32)))
+      self.assertTrue(numpy.all(rfld2 == wfld2.astype(numpy.float32)))
+
+   def test_afile_chunked_write(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld=numpy.random.rand(jdm,idm)
+      mask=wfld > 0.9
+      mask[0:4,:]=True                     # Masked rows, in the first chunks
+      mask[-1,:]=True
+      wfld[1,3]=-10.                       # Masked extremes must not enter min/max
+      wfld[-1,0]=10.
+
+      def write(basename,chunksize) :
+         AFile=modeltools.hycom.old.hycom_io.AFile
+         tmp=AFile._write_chunksize
+         AFile._write_chunksize=chunksize
+         try :
+            regfile=modeltools.hycom.old.hycom_io.ABFileGrid(basename,"w",mask=True)
+            regfile.write_field(wfld,mask,"plon")
+            regfile.write_field(wfld*2.,mask,"plat")
+            regfile.close()
+         finally :
+            AFile._write_chunksize=tmp
+         return open(basename+".a","rb").read(),open(basename+".b").read()
+
+      a1,b1=write("testgrid0",idm*jdm)
+      a2,b2=write("testgrid1",3*idm)
+      self.assertEqual(a1,a2)
+      self.assertEqual(b1,b2)
+      regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid1","r")
+      self.assertEqual(regfile._fields[0]["min"],float("%16.8g"%wfld[~mask].min()))
+      self.assertEqual(regfile._fields[0]["max"],float("%16.8g"%wfld[~mask].max()))
+      regfile.close()
+
+   def test_afile_iter_tiles(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld=numpy.random.rand(jdm,idm)
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w")
+      afile.writerecord(wfld,None)
+      afile.close()
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r")
+      rfld=numpy.zeros((jdm,idm))
+      for j0,j1,block in afile.iter_tiles(0,rows=7) :
+         self.assertTrue(block.shape == (j1-j0,idm))
+         rfld[j0:j1,:] = block
+      afile.close()
+      self.assertTrue(numpy.all(rfld == wfld.astype(numpy.float32)))
+
+   def test_afile_float32_roundtrip(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld=(numpy.random.rand(jdm,idm)*1e4).astype(numpy.float32)
+      mask=wfld > 9e3
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w",mask=True,dtype=numpy.float32)
+      hmin,hmax=afile.writerecord(wfld,mask)
+      afile.close()
+      self.assertEqual(hmin,wfld[~mask].min())
+      self.assertEqual(hmax,wfld[~mask].max())
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r",dtype=numpy.float32)
+      rfld=afile.readrecord(0)
+      afile.close()
+      self.assertEqual(rfld.dtype,numpy.float32)
+      self.assertTrue(numpy.all(rfld.mask == mask))
+      self.assertTrue(numpy.array_equal(rfld.data[~mask],wfld[~mask]))
+
+      # Write what was read, file contents must be bit-exact
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test2.a","w",mask=True,dtype=numpy.float32)
+      afile.writerecord(rfld.data,rfld.mask)
+      afile.close()
+      self.assertEqual(open("test.a","rb").read(),open("test2.a","rb").read())
+
+   def test_afile_readrecords(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wflds=[numpy.random.rand(jdm,idm) for k in range(5)]
+      mask=wflds[0] > 0.9
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w",mask=True)
+      for wfld in wflds :
+         afile.writerecord(wfld,mask)
+      afile.close()
+
+      records=[3,0,4,3,1]
+      for memmap in [False,True] :
+         afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r",memmap=memmap)
+         for nthreads in [1,3] :
+            rflds=afile.readrecords(records,nthreads=nthreads)
+            self.assertEqual(rflds.shape,(len(records),jdm,idm))
+            for k,record in enumerate(records) :
+               rfld=afile.readrecord(record)
+               self.assertTrue(numpy.all(rflds[k].mask == rfld.mask))
+               self.assertTrue(numpy.array_equal(rflds[k].data,rfld.data))
+         afile.close()
+
+   def test_afile_unmasked_record_mask(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wfld=numpy.random.rand(jdm,idm)
+
+      afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","w")
+      afile.writerecord(wfld,None)
+      afile.close()
+
+      # Records without masked values still have a full (jdm,idm) mask
+      for memmap in [False,True] :
+         afile=modeltools.hycom.old.hycom_io.AFile(idm,jdm,"test.a","r",memmap=memmap)
+         rfld=afile.readrecord(0)
+         self.assertEqual(rfld.mask.shape,(jdm,idm))
+         self.assertFalse(rfld.mask.any())
+         for j0,j1,block in afile.iter_tiles(0,rows=7) :
+            self.assertEqual(block.mask.shape,(j1-j0,idm))
+         self.assertEqual(afile.readrecords([0,0],nthreads=1)[1].mask.shape,(jdm,idm))
+         afile.close()
+
+   def test_abfile_read_fields(self) :
+      idm = random.randrange(10,500)
+      jdm = random.randrange(10,500)
+      wflds=dict([(name,numpy.random.rand(jdm,idm)) for name in ["plon","plat","qlon"]])
+
+      regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid","w")
+      for name in ["plon","plat","qlon"] :
+         regfile.write_field(wflds[name],None,name)
+      regfile.close()
+
+      regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid","r")
+      rflds=regfile.read_fields(["qlon","plon"],nthreads=2)
+      self.assertTrue(numpy.all(rflds[0] == regfile.read_field("qlon")))
+      self.assertTrue(numpy.all(rflds[1] == wflds["plon"].astype(numpy.float32)))
+      self.assertRaises(modeltools.hycom.old.hycom_io.BFileError,regfile.read_fields,["ulon"])
+      regfile.close()
+
+   def test_abfile_index_cache(self) :
+      import os
+      import json
+      idm = random.randrange(10,100)
+      jdm = random.randrange(10,100)
+      def write_grid(names) :
+         regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid","w")
+         for name in names :
+            regfile.write_field(numpy.random.rand(jdm,idm),None,name)
+         regfile.close()
+      def fieldnames() :
+         regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid","r")
+         tmp=regfile.fieldnames
+         regfile.close()
+         return tmp
+
+      write_grid(["plon","plat"])
+      if os.path.exists("testgrid.b.idx") : os.remove("testgrid.b.idx")
+      modeltools.hycom.old.hycom_io.set_index_cache()
+      try :
+         self.assertEqual(fieldnames(),set(["plon","plat"]))
+         self.assertTrue(os.path.exists("testgrid.b.idx"))
+
+         # Unchanged .b file, field info is taken from the index
+         tmp=json.load(open("testgrid.b.idx"))
+         tmp["fields"]["1"]["field"]="xxxx"
+         json.dump(tmp,open("testgrid.b.idx","w"))
+         self.assertEqual(fieldnames(),set(["plon","xxxx"]))
+
+         # Field info from the index has the types of parsed field info
+         regfile=modeltools.hycom.old.hycom_io.ABFileGrid("testgrid","r")
+         self.assertEqual(sorted(regfile._fields.keys()),[0,1])
+         self.assertTrue(type(regfile._fields[0]["field"]) is str)
+         self.assertTrue(type(regfile._fields[0]["min"]) is float)
+         regfile.close()
+
+         # Unreadable index is ignored
+         open("testgrid.b.idx","w").write("garbage")
+         self.assertEqual(fieldnames(),set(["plon","plat"]))
+
+         # Changed size of .b file
+         write_grid(["plon","plat","qlon"])
+         self.assertEqual(fieldnames(),set(["plon","plat","qlon"]))
+
+         # Same size, changed modification time
+         st=os.stat("testgrid.b")
+         tmp=open("testgrid.b").read().replace("qlon","ulon")
+         open("testgrid.b","w").write(tmp)
+         os.utime("testgrid.b",(st.st_atime,st.st_mtime+10))
+         self.assertEqual(os.stat("testgrid.b").st_size,st.st_size)
+         self.assertEqual(fieldnames(),set(["plon","plat","ulon"]))
+      finally :
+         modeltools.hycom.old.hycom_io.set_index_cache(False)
+
+   def test_iter_fields_prefetched(self) :
+      idm = random.randrange(10,100)
+      jdm = random.randrange(10,100)
+      basenames=["testgrid%d"%k for k in range(5)]
+      for basename in basenames :
+         regfile=modeltools.hycom.old.hycom_io.ABFileGrid(basename,"w")
+         for name in ["plon","plat"] :
+            regfile.write_field(numpy.random.rand(jdm,idm),None,name)
+         regfile.close()
+
+      fields=["plat","plon"]
+      result=list(modeltools.hycom.old.hycom_io.iter_fields_prefetched(basenames,fields,
+         abclass=modeltools.hycom.old.hycom_io.ABFileGrid,depth=2))
+      self.assertEqual([elem[0] for elem in result],basenames)
+      for basename,data in result :
+         regfile=modeltools.hycom.old.hycom_io.ABFileGrid(basename,"r")
+         for k,name in enumerate(fields) :
+            self.assertTrue(numpy.array_equal(data[k],regfile.read_field(name)))
+         regfile.close()
+
+   def test_read_regional_grid_cache(self) :
+      import os
+      import shutil
+      idm = random.randrange(10,100)
+      jdm = random.randrange(10,100)
+      regfile=modeltools.hycom.old.hycom_io.ABFileGrid("regional.grid","w")
+      for name in modeltools.hycom.old.hycom_io._regional_grid_fields :
+         wfld=numpy.random.rand(jdm,idm)
+         if name == "pang" : wfld[0,0]=2.0**100   # Masked when read
+         regfile.write_field(wfld,None,name)
+      regfile.close()
+      if os.path.exists("testgrid.cache") : shutil.rmtree("testgrid.cache")
+
+      inflds0=modeltools.hycom.old.hycom_io.read_regional_grid()
+      inflds1=modeltools.hycom.old.hycom_io.read_regional_grid(cache=True,cachedir="testgrid.cache")
+      inflds2=modeltools.hycom.old.hycom_io.read_regional_grid(cache=True,cachedir="testgrid.cache")
+      self.assertTrue(os.path.exists(os.path.join("testgrid.cache","plon.npy")))
+      self.assertEqual(numpy.load(os.path.join("testgrid.cache","plon.npy")).dtype,numpy.float32)
+      for name in modeltools.hycom.old.hycom_io._regional_grid_fields :
+         for inflds in [inflds1,inflds2] :
+            # Cache miss and hit return the same kind of arrays as an uncached read
+            self.assertEqual(inflds[name].dtype,inflds0[name].dtype)
+            self.assertEqual(inflds[name].flags.writeable,inflds0[name].flags.writeable)
+            self.assertEqual(inflds[name].mask.shape,inflds0[name].mask.shape)
+            self.assertEqual(inflds[name].mask.shape,(jdm,idm))
+            self.assertTrue(numpy.all(numpy.ma.getmaskarray(inflds[name]) == numpy.ma.getmaskarray(inflds0[name])))
+            self.assertTrue(numpy.array_equal(numpy.ma.getdata(inflds[name]),numpy.ma.getdata(inflds0[name])))
+      self.assertTrue(inflds2["pang"].mask[0,0])
+      shutil.rmtree("testgrid.cache")
+
    def test_abfilebathy_writeread_nomask(self) :
       idm = random.randrange(10,5000)
       jdm = random.randrange(10,5000)
@@ -1,5 +1,5 @@
 from _rotate        import rotate_vector,rotateVector
-from _interpolation import FieldInterpolatorBilinear, FieldInterpolatorRectBivariateSpline, extrapolate_data
-from _indata        import FieldReader, NetcdfFieldReader, ForcingField, ForcingFieldFromXml, ForcingFieldCopy
+from _interpolation import FieldInterpolatorBilinear, FieldInterpolatorRectBivariateSpline, get_field_interpolator, extrapolate_data
+from _indata        import FieldReader, NetcdfFieldReader, ForcingField, ForcingFieldFromXml, ForcingFieldCopy, NetcdfDatasetPool, netcdf_dataset_pool, UnitConverter, get_units, get_unit_converter
 from _misc          import shapiro_filter, remove_one_neighbour_cells, remove_islets, remove_isolated_basins, spherdist_haversine, p_azimuth, fwd_azimuth, remove_inconsistent_nesting_zone
 from _integration   import isopycnal_coordinate_layers
@@ -8,6 +8,11 @@ import datetime
 import cfunits
 import netcdftime
 import scipy
+import os
+import collections
+import threading
+import hashlib
+import sys
 
 
 # Set up logger
@@ -27,12 +32,200 @@ class FieldReaderError(Exception):
     pass
 
 
+def _time_index(t) :
+   """ Returns first time of t, and the sort order and sorted int64 seconds of t relative to it """
+   time0 = t[0]
+   tmp = [ i-time0 for i in t ]
+   tmp = numpy.array([ i.days*86400 + i.seconds for i in tmp ],dtype=numpy.int64)
+   order = numpy.argsort(tmp,kind="mergesort")
+   return time0,order,tmp[order]
+
+
+# Meshgrids shared between readers and files with identical coordinates. See _shared_meshgrid
+_meshgrid_cache = collections.OrderedDict()
+_meshgrid_cache_size = 8
+_meshgrid_lock = threading.Lock()
+
+def _shared_meshgrid(x,y) :
+   """ numpy.meshgrid(x,y), computed once per unique x,y. Returned arrays are read-only """
+   key=[]
+   for elem in [x,y] :
+      tmp = numpy.ascontiguousarray(numpy.ma.getdata(elem))
+      key.append((tmp.dtype.str,tmp.shape,hashlib.sha1(tmp.tobytes()).hexdigest()))
+   key = tuple(key)
+   with _meshgrid_lock :
+      if key in _meshgrid_cache :
+         grid = _meshgrid_cache.pop(key)
+      else :
+         grid = numpy.meshgrid(x,y)
+         for elem in grid : elem.flags.writeable=False
+      _meshgrid_cache[key] = grid
+      while len(_meshgrid_cache) > _meshgrid_cache_size :
+         _meshgrid_cache.popitem(last=False)
+   return grid
+
+
+def _fractional_index(coord,target,periodic) :
+   # Fractional index of target values in 1D coordinate coord. If periodic (global longitude),
+   # coord is assumed to be regular, and the returned index is in [0,coord.size)
+   coord = numpy.asarray(numpy.ma.getdata(coord),dtype=numpy.float64)
+   target = numpy.asarray(numpy.ma.getdata(target),dtype=numpy.float64).ravel()
+   n = coord.size
+   if periodic :
+      d = (coord[-1]-coord[0])/(n-1)
+      return numpy.mod((target-coord[0])/d,n)
+   elif coord[-1] >= coord[0] :
+      return numpy.interp(target,coord,numpy.arange(n))
+   else :
+      return n-1-numpy.interp(target,coord[::-1],numpy.arange(n))
+
+
+def subset_bounds(lon,lat,targetlon,targetlat,halo=2) :
+   """ Returns index bounds of the part of the 1D coordinates lon, lat needed to interpolate
+   to targetlon, targetlat, extended by halo points in each direction.
+
+   Returns tuple (jslice,islices,sublon,sublat). jslice is a slice of lat, islices a list of slices
+   of lon (two if the subset crosses the end of a global longitude coordinate). sublon and sublat
+   are the coordinates of the subset. Longitudes of a wrapped subset are made continuous by
+   adding 360 degrees to the wrapped part """
+   lonval = numpy.ma.getdata(lon)
+   nx,ny  = lonval.size,numpy.size(lat)
+   dlon   = (float(lonval[-1])-float(lonval[0]))/(nx-1)
+   periodic = abs(abs(dlon)*nx - 360.0) < 1e-4
+
+   # Latitude range, not periodic
+   fj  = _fractional_index(lat,targetlat,False)
+   j0  = max(int(numpy.floor(fj.min()))-halo,0)
+   j1  = min(int(numpy.floor(fj.max()))+2+halo,ny)
+   jslice = slice(j0,j1)
+
+   # Target longitudes relative to smallest longitude of coordinate (targets may be in another range)
+   lonmin = float(lonval.min())
+   tlon = numpy.mod(numpy.asarray(targetlon,dtype=numpy.float64)-lonmin,360.)+lonmin
+   fi = _fractional_index(lon,tlon,periodic)
+   i = numpy.floor(fi).astype(int)
+   if not periodic :
+      i0 = max(i.min()-halo,0)
+      i1 = min(i.max()+2+halo,nx)
+      return jslice,[slice(i0,i1)],lon[i0:i1],lat[jslice]
+
+   # Periodic: Find largest gap between used points, the subset is the rest
+   used = numpy.zeros(nx,dtype=bool)
+   used[i] = True
+   used[numpy.mod(i+1,nx)] = True
+   p = numpy.where(used)[0]
+   gaps = numpy.diff(numpy.concatenate((p,[p[0]+nx])))   # Gap after p[k], wrapping around the end
+   k = numpy.argmax(gaps)
+   start  = p[(k+1)%p.size]-halo
+   length = nx-(gaps[k]-1)+2*halo
+   if length >= nx :
+      return jslice,[slice(0,nx)],lon,lat[jslice]
+   start = start % nx
+   ind = start + numpy.arange(length)
+   if start+length <= nx :
+      islices = [slice(start,start+length)]
+   else :
+      islices = [slice(start,nx),slice(0,start+length-nx)]
+   sublon = lon[numpy.mod(ind,nx)] + numpy.sign(dlon)*360.*(ind//nx)
+   return jslice,islices,sublon,lat[jslice]
+
+
+# Units and unit converters, created once per unit string / unit pair. See get_units, get_unit_converter
+_units_cache = {}
+_unit_converter_cache = {}
+_units_lock = threading.Lock()
+
+def get_units(unit) :
+   """ Returns cfunits.Units for unit string unit (or unit itself if it is already a cfunits.Units) """
+   if isinstance(unit,cfunits.Units) :
+      return unit
+   with _units_lock :
+      if unit not in _units_cache :
+         _units_cache[unit] = cfunits.Units(unit)
+      return _units_cache[unit]
+
+
+def get_unit_converter(from_unit,to_unit) :
+   """ Returns UnitConverter from from_unit to to_unit, created once per unit pair """
+   from_unit = get_units(from_unit)
+   to_unit   = get_units(to_unit)
+   key = (str(from_unit),getattr(from_unit,"calendar",None),str(to_unit),getattr(to_unit,"calendar",None))
+   with _units_lock :
+      if key not in _unit_converter_cache :
+         _unit_converter_cache[key] = UnitConverter(from_unit,to_unit)
+      return _unit_converter_cache[key]
+
+
+class UnitConverter(object) :
+   """ Converts data between two cfunits.Units.
+
+   The conversion is resolved once by conforming a few probe values with cfunits. If it
+   is affine (to = scale*from + offset) it is applied with numpy, otherwise
+   cfunits.Units.conform is used on the data """
+
+   _probe = numpy.array([0.,1.,10.,1000.,-273.15])
+
+   def __init__(self,from_unit,to_unit) :
+      self._from_unit = from_unit
+      self._to_unit   = to_unit
+      self._identity  = bool(from_unit.equals(to_unit))
+      self._affine    = True
+      self._scale     = 1.
+      self._offset    = 0.
+      if not self._identity :
+         tmp = numpy.asarray(cfunits.Units.conform(self._probe,from_unit,to_unit),dtype=numpy.float64)
+         self._offset = tmp[0]
+         self._scale  = tmp[1]-tmp[0]
+         self._affine = bool(numpy.all(numpy.isfinite(tmp))) and \
+               numpy.allclose(tmp,self._scale*self._probe+self._offset,rtol=1e-12,atol=0.)
+         if not self._affine :
+            logger.info("Conversion from %s to %s is not affine, using cfunits"%(str(from_unit),str(to_unit)))
+
+   def __call__(self,data,inplace=False) :
+      """ Returns data converted to target unit. With inplace=True, floating point arrays are modified in place """
+      if self._identity :
+         if inplace :
+            return data
+         else :
+            return numpy.copy(data) if not isinstance(data,numpy.ma.MaskedArray) else data.copy()
+      elif not self._affine :
+         return cfunits.Units.conform(data,self._from_unit,self._to_unit)
+      elif inplace and isinstance(data,numpy.ndarray) and numpy.issubdtype(data.dtype,numpy.floating) :
+         if self._scale <> 1. : data *= self._scale
+         if self._offset <> 0. : data += self._offset
+         return data
+      else :
+         tmp = data*self._scale
+         if self._offset <> 0. : tmp += self._offset
+         return tmp
+
+   @property
+   def is_identity(self) :
+      return self._identity
+
+   @property
+   def is_affine(self) :
+      return self._affine
+
+   @property
+   def scale(self) :
+      return self._scale
+
+   @property
+   def offset(self) :
+      return self._offset
+
+
 class FieldReader(object) :
-   def __init__(self,filenametemplate,coord_props={},time_offset=datetime.timedelta(0)) :
+   def __init__(self,filenametemplate,coord_props={},time_offset=datetime.timedelta(0),time_tolerance=None) :
       self._filenametemplate = filenametemplate
       self._filename         = None
       self._coord_props      = coord_props
       self._time_offset      = time_offset  
+      self._time_tolerance   = time_tolerance
+      self._grids            = {}               # Meshgrids of opened file, see get_grid
+      self._subset           = None             # Target grid and halo, see set_subset
+      self._subset_index     = None             # Subset of opened file, see subset_bounds
 
 
    def file_is_open(self,newfilename) :
@@ -43,28 +236,78 @@ class FieldReader(object) :
       else :
          return False
 
-   def find_timestep(self,dt,varname) :
-      tmp = self._coordmap[varname]["time"]-dt
-      #print self._filename
-      #print dt
-      #print tmp[0]
-      tmp = [ i.days*86400 + i.seconds  for i in tmp]
-      #print tmp[0]
-      #print numpy.where(numpy.array(tmp)==0)
-      I = numpy.where(numpy.array(tmp)==0)[0]
-      return I
+   def _build_time_index(self) :
+      # Time coordinate as sorted int64 seconds relative to first time. Built once per opened file
+      self._time0,self._time_order,self._time_seconds = _time_index(self._coordvar["time"])
+
+
+   def find_timestep(self,dt,varname,tolerance=None) :
+      """ Returns index array of time step dt in file (empty if not found). If tolerance
+      (timedelta) is given, the nearest time within tolerance is used. Default tolerance is
+      the one given to the reader, None means exact match (to the second) """
+      if tolerance is None :
+         tolerance = self._time_tolerance
+      tmp = self._time0-dt
+      isec = -(tmp.days*86400 + tmp.seconds)
+      k = numpy.searchsorted(self._time_seconds,isec)
+      n = self._time_seconds.size
+      if tolerance is None :
+         if k < n and self._time_seconds[k] == isec :
+            return self._time_order[k:k+1]
+      else :
+         tol = tolerance.days*86400 + tolerance.seconds
+         cands = [elem for elem in [k-1,k] if elem >= 0 and elem < n]
+         if cands :
+            best = min(cands,key=lambda elem : abs(self._time_seconds[elem]-isec))
+            if abs(self._time_seconds[best]-isec) <= tol :
+               return self._time_order[best:best+1]
+      return numpy.array([],dtype=int)
+
+
+   def set_subset(self,targetlon,targetlat,halo=2) :
+      """ Only read the part of the fields needed to interpolate to targetlon, targetlat (plus
+      halo points). Coordinates and grids returned by the reader are then those of the subset.
+      Use targetlon=None to read full fields """
+      if targetlon is None :
+         self._subset = None
+      else :
+         self._subset = (numpy.asarray(targetlon),numpy.asarray(targetlat),halo)
+      if self._filename is not None :
+         self._build_subset_index()
+
+
+   def _build_subset_index(self) :
+      # Index bounds of subset in opened file. Called on open (or init) by subclasses
+      if self._subset is None :
+         self._subset_index = None
+      else :
+         self._subset_index = subset_bounds(self._coordvar["lon"],self._coordvar["lat"],*self._subset)
+         logger.info("Reading subset j=%s, i=%s of %s"%(str(self._subset_index[0]),str(self._subset_index[1]),
+            self._filename))
 
 
    def get_grid(self,varname,dt) :
+      """ Returns meshgrid of coordinates. The (read-only) arrays are computed once per file
+      and shared with other fields and readers with the same coordinates """
       self.open_if_needed(dt)
-      if self._coordrank[varname]["lon"] > self._coordrank[varname]["lat"] :
-         return numpy.meshgrid(self._coordvar["lon"],self._coordvar["lat"])
-      else:
-         return numpy.meshgrid(self._coordvar["lat"],self._coordvar["lon"])
+      lonfirst = self._coordrank[varname]["lon"] > self._coordrank[varname]["lat"]
+      key = lonfirst
+      if self._subset_index is not None :
+         key = (lonfirst,self._subset_index[0].indices(sys.maxint),
+               tuple([elem.indices(sys.maxint) for elem in self._subset_index[1]]))
+      if key not in self._grids :
+         lon,lat = self.get_coords(varname,dt)
+         if lonfirst :
+            self._grids[key] = _shared_meshgrid(lon,lat)
+         else:
+            self._grids[key] = _shared_meshgrid(lat,lon)
+      return self._grids[key]
 
 
    def get_coords(self,varname,dt) :
       self.open_if_needed(dt)
+      if self._subset_index is not None :
+         return self._subset_index[2],self._subset_index[3]
       return self._coordvar["lon"],self._coordvar["lat"]
 
 
@@ -72,18 +315,75 @@ class FieldReader(object) :
       raise NotImplementedError,"get_proj4grid not implemented"
 
 
+   def get_timesteps(self,varname,dts,skip_missing=False) :
+      """ Returns list of fields at times dts, each as returned by get_timestep. Time steps
+      in the same file are read with one call per contiguous run of time indexes.
+      If skip_missing is True, None is returned for time steps that can not be read
+      (missing file or time). Otherwise IOError is raised for missing files and
+      FieldReaderError for times not found in the file """
+      result = [None for dt in dts]
+
+      # Group time steps by file, keeping the order of dts within a file
+      groups = collections.OrderedDict()
+      for i,dt in enumerate(dts) :
+         filename = (dt-self._time_offset).strftime(self._filenametemplate)
+         groups.setdefault(filename,[]).append(i)
+
+      for filename,ilist in groups.items() :
+         try :
+            self.open_if_needed(dts[ilist[0]])
+         except (IOError,OSError) :
+            if skip_missing :
+               logger.warning("Could not open %s, skipping %d time steps"%(filename,len(ilist)))
+               continue
+            raise
+
+         # Time index in file of each time step
+         found = []
+         for i in ilist :
+            I = self.find_timestep(dts[i],varname)
+            if I.size > 0 :
+               found.append((int(I[0]),i))
+            elif not skip_missing :
+               raise FieldReaderError,"Time %s not found in %s"%(str(dts[i]),filename)
+         found.sort()
+
+         # Read runs of contiguous time indexes as one slab
+         k=0
+         while k < len(found) :
+            l=k
+            while l+1 < len(found) and found[l+1][0] - found[l][0] <= 1 :
+               l+=1
+            i0 = found[k][0]
+            slab = self._read_slab(varname,i0,found[l][0]+1)
+            for m in range(k,l+1) :
+               j = found[m][0]-i0
+               result[found[m][1]] = slab[j:j+1]
+            k=l+1
+      return result
+
+
+   def _read_slab(self,varname,i0,i1) :
+      raise NotImplementedError,"_read_slab not implemented"
+
+
 
    @classmethod
-   def get_field_reader(cls,filenametemplate,format,coord_props=None,time_offset=datetime.timedelta(0)) :
+   def get_field_reader(cls,filenametemplate,format,coord_props=None,time_offset=datetime.timedelta(0),
+         time_tolerance=None) :
       if format == "netcdf" :
-         return NetcdfFieldReader(filenametemplate,coord_props=coord_props,time_offset=time_offset)
+         return NetcdfFieldReader(filenametemplate,coord_props=coord_props,time_offset=time_offset,
+               time_tolerance=time_tolerance)
       else :
          raise FieldReaderError,"Only netcdf supported at the moment"
 
 
-class NetcdfFieldReader(FieldReader) :
-   def __init__(self,filenametemplate,coord_props={},time_offset=datetime.timedelta(0)) :
-      super(NetcdfFieldReader,self).__init__(filenametemplate,coord_props=coord_props,time_offset=time_offset)
+class NetcdfDataset(object) :
+   """ An open netCDF file with decoded and mapped coordinate variables """
+   def __init__(self,filename,coord_props={}) :
+      self._filename    = filename
+      self._coord_props = coord_props
+      self.open()
 
    def open(self) :
       #self._nc = scipy.io.netcdf.netcdf_file(self._filename,"r")
@@ -163,18 +463,129 @@ class NetcdfFieldReader(FieldReader) :
          #print self._coordmap[varname].keys()
       #print "open finished"
 
+      if "time" in self._coordvar :
+         self._time_index = _time_index(self._coordvar["time"])
+      else :
+         self._time_index = None
+      self._grids = {}
+
    def close(self) :
+      logger.info("Closing %s"%self._filename)
       self._nc.close()
+      self._nc = None
+
+   @property
+   def isopen(self) :
+      return self._nc is not None
+
+   @property
+   def nc(self) : return self._nc
+
+   @property
+   def coordvar(self) : return self._coordvar
+
+   @property
+   def coordmap(self) : return self._coordmap
+
+   @property
+   def coordrank(self) : return self._coordrank
+
+   @property
+   def time_index(self) : return self._time_index
+
+   @property
+   def grids(self) : return self._grids
+
+
+
+class NetcdfDatasetPool(object) :
+   """ Process wide pool of open NetcdfDataset objects, shared by all NetcdfFieldReader
+   instances. Files are opened and their coordinates decoded once. At most maxsize files are
+   kept open, the least recently used file is closed first """
+   def __init__(self,maxsize=16) :
+      self._maxsize = maxsize
+      self._datasets = collections.OrderedDict()
+      self._lock = threading.RLock()
+
+   @classmethod
+   def _key(cls,filename,coord_props) :
+      props = tuple(sorted([(k,tuple(sorted(v.items()))) for k,v in coord_props.items()]))
+      return os.path.abspath(filename),props
+
+   def get(self,filename,coord_props={}) :
+      """ Returns open NetcdfDataset for filename, decoded using coord_props """
+      key = self._key(filename,coord_props)
+      with self._lock :
+         if key in self._datasets :
+            ds = self._datasets.pop(key)
+         else :
+            ds = NetcdfDataset(filename,coord_props=coord_props)
+         self._datasets[key] = ds
+         self._evict()
+      return ds
+
+   def _evict(self) :
+      while len(self._datasets) > max(1,self._maxsize) :
+         key,ds = self._datasets.popitem(last=False)
+         ds.close()
+
+   def close_all(self) :
+      with self._lock :
+         for ds in self._datasets.values() :
+            ds.close()
+         self._datasets.clear()
+
+   @property
+   def maxsize(self) :
+      return self._maxsize
+
+   @maxsize.setter
+   def maxsize(self,maxsize) :
+      with self._lock :
+         self._maxsize = maxsize
+         self._evict()
+
+# Pool used by NetcdfFieldReader. Set netcdf_dataset_pool.maxsize to change number of open files
+netcdf_dataset_pool = NetcdfDatasetPool()
+
+
+
+class NetcdfFieldReader(FieldReader) :
+   def __init__(self,filenametemplate,coord_props={},time_offset=datetime.timedelta(0),time_tolerance=None) :
+      if coord_props is None : coord_props = {}
+      super(NetcdfFieldReader,self).__init__(filenametemplate,coord_props=coord_props,time_offset=time_offset,
+            time_tolerance=time_tolerance)
+      self._dataset = None
+
+   def open(self) :
+      # Get open file and decoded coordinates from pool
+      self._dataset   = netcdf_dataset_pool.get(self._filename,self._coord_props)
+      self._nc        = self._dataset.nc
+      self._coordvar  = self._dataset.coordvar
+      self._coordmap  = self._dataset.coordmap
+      self._coordrank = self._dataset.coordrank
+      self._grids     = self._dataset.grids
+      if self._dataset.time_index is not None :
+         self._time0,self._time_order,self._time_seconds = self._dataset.time_index
+      self._build_subset_index()
+
+   def close(self) :
+      # File is left open in pool, for use by other readers
+      self._dataset = None
+      self._nc = None
       self._filename=None
 
    def open_if_needed(self,dt) :
-      # Open file if necessary
+      # Open file if necessary. File may also have been closed by the pool
       tmpdt=dt-self._time_offset
       newfilename=tmpdt.strftime(self._filenametemplate)
-      if not self.file_is_open(newfilename) : 
-         if self._filename is not None : self._nc.close()
+      if not self.file_is_open(newfilename) or not self._dataset.isopen :
          self._filename = newfilename
-         self.open()
+         try :
+            self.open()
+         except :
+            self.close()
+            raise
 
 
    def get_timestep(self,varname,dt) :
@@ -185,7 +596,32 @@ class NetcdfFieldReader(FieldReader) :
 
       #Find timestep
       I = self.find_timestep(dt,varname)
-      return self._nc.variables[varname][I,:] # Will actually read 3D, 4D etc
+      return self._read(varname,I) # Will actually read 3D, 4D etc
+
+
+   def _read_slab(self,varname,i0,i1) :
+      # Reads time indexes i0 to i1 (exclusive) of varname in open file
+      return self._read(varname,slice(i0,i1))
+
+
+   def _read(self,varname,I) :
+      # Reads time index I of varname, only the subset if set
+      var = self._nc.variables[varname]
+      if self._subset_index is None :
+         return var[I,:]
+      jslice,islices = self._subset_index[:2]
+      rank = self._coordrank[varname]
+      pieces=[]
+      for islice in islices :
+         ind = [slice(None) for elem in var.dimensions]
+         ind[rank["time"]] = I
+         ind[rank["lat"]]  = jslice
+         ind[rank["lon"]]  = islice
+         pieces.append(var[tuple(ind)])
+      if len(pieces) == 1 :
+         return pieces[0]
+      else :
+         return numpy.ma.concatenate(pieces,axis=rank["lon"])
 
 
 
@@ -194,7 +630,8 @@ class NetcdfFieldReader(FieldReader) :
 # To implement other readers:
 # Subclass FieldReader
 # on open (or init) : Define self._coordvar (gets coordinate variables in file)
-#                     Time coordinate must be defined as datetime
+#                     Time coordinate must be defined as datetime, then call self._build_time_index()
+#                     Reset self._grids = {}, and call self._build_subset_index()
 # on open (or init) : Define self._coordmap (links variables to coord variables)
 # Implement init, open, get_timestep and close
 
@@ -205,7 +642,7 @@ class NetcdfFieldReader(FieldReader) :
 class ForcingField(object) :
 
    def __init__(self,name,filenametemplate,varname,unit,format,accumulation_time=None,rootPath=None,
-         coord_props={}) :
+         coord_props={},time_tolerance=None) :
       self._name             = name             # Variable names known to this module
       self._filenametemplate = filenametemplate # File known to this module
       self._varname          = varname          # Variable name in file
@@ -234,30 +671,46 @@ class ForcingField(object) :
       #print name,accumulation_time
 
 
-      self._cfunit             = cfunits.Units(units=self._units)
+      # Nearest time in file within time_tolerance is used if there is no exact match, see FieldReader.find_timestep
+      if time_tolerance is not None and not isinstance(time_tolerance,datetime.timedelta) :
+         m = re.match("^([0-9]+)([hms])$",time_tolerance)
+         if not m :
+            raise FieldReaderError,"time tolerance must be specified as a number + letter 'h', 'm' or 's'"
+         time_tolerance = datetime.timedelta(seconds=int(m.group(1))*{"h":3600,"m":60,"s":1}[m.group(2)])
+
+      self._cfunit             = get_units(self._units)
       self._format             = format
-      self._fieldreader = FieldReader.get_field_reader(self._filenametemplate,format,coord_props=coord_props,time_offset=self._accumulation_time) 
+      self._fieldreader = FieldReader.get_field_reader(self._filenametemplate,format,coord_props=coord_props,time_offset=self._accumulation_time,
+            time_tolerance=time_tolerance)
+
+      # Cache of most recently read records, see _read_record
+      self._records      = collections.OrderedDict()
+      self._records_size = 2
+      self._window       = {}
 
 
 
    def get_timestep(self,dt,unit=None) : 
+      self.set_timestep(*self.read_timestep(dt,unit=unit))
+      logger.info("Reading name %20s, varname=%20s"%(self._name,self._varname))
+
+
+   def read_timestep(self,dt,unit=None) :
+      """ Read field at dt without changing data, time, coords and grid of this field.
+      Returns tuple (data,time,coords,grid), which can be passed on to set_timestep """
 
       outdt=dt
 
       # Do unit conversion to get correct output unit
       if unit is not None :
-         mycfunit = cfunits.Units(unit)
+         mycfunit = get_units(unit)
+      else :
+         mycfunit = self._cfunit
 
       logger.debug("Varname %s : imposed unit=%s, my unit=%s"%(self._varname,str(mycfunit), self._units))
 
-      #tmp = numpy.squeeze(self._fieldreader.get_timestep(self._varname,dt))
-      tmp = numpy.squeeze(self._fieldreader.get_timestep(self._varname,dt))*self._accumulation_scale_factor
-      if not self._cfunit.equals(mycfunit) :
-         #print "Unit conversion:",self.varname,"unit=",self._cfunit, "targetunit=", mycfunit
-         #print "Unit conversion:max=",tmp.max()
-         #print self._accumulation_time
-         tmp=cfunits.Units.conform(tmp,self._cfunit,mycfunit)
-         #print "Unit conversion:max after=",tmp.max()
+      # Records at dt are not needed again in a sequential run, so they are taken out of the cache
+      tmp = self._read_record(dt,mycfunit,keep=False)
 
 #Approach 2: Calculate average at this time
       # If this is an accumulated field, we need to get next field and interpolate
@@ -265,25 +718,78 @@ class ForcingField(object) :
       if self._accumulation_time <> datetime.timedelta(0):
          dt2 = dt + self._accumulation_time
          logger.info("Computing interpolated value for accumulated field %s (Reading additional field at %s)"%(self._varname,str(dt2)))
-         tmp2 = numpy.squeeze(self._fieldreader.get_timestep(self._varname,dt2))*self._accumulation_scale_factor
-         if not self._cfunit.equals(mycfunit) :
-            #print "Unit conversion:",self.varname,"unit=",self._cfunit, "targetunit=", mycfunit
-            #print "Unit conversion:max=",tmp.max()
-            tmp2=cfunits.Units.conform(tmp2,self._cfunit,mycfunit)
-            #print "Unit conversion:max after=",tmp.max()
+         tmp2 = self._read_record(dt2,mycfunit,keep=True)
          tmp = 0.5*(tmp + tmp2)
          outdt = dt
 
+      # Grid and coords are references to arrays cached by the reader
+      coords = self._fieldreader.get_coords(self._varname,dt)
+      grid   = self._fieldreader.get_grid(self._varname,dt)
+      return tmp,outdt,coords,grid
+
+
+   def set_timestep(self,data,time,coords,grid) :
+      """ Sets data, time, coords and grid of this field (as returned by read_timestep) """
+      self._data=data
+      self._time=time
+      self._coordx,self._coordy = coords
+      self._gridx ,self._gridy  = grid
+
+   def _read_record(self,dt,mycfunit,keep=True) :
+      """ Read record at dt, scaled to flux if accumulated and converted to unit mycfunit.
+
+      Records are kept in a small cache, so that the second record of an accumulated field
+      is not read again as the first record of the next time step. With keep=False, a
+      cached record is removed from the cache when returned (the caller may then modify it) """
+      key = (dt,str(mycfunit))
+      if key in self._records :
+         if keep :
+            return self._records[key]
+         else :
+            return self._records.pop(key)
 
-      #TODO - may be optimized out
-      # Sets grid and coords explicitly upon read
-      logger.debug("NB: Implicit read of coordinates and grid when reading variable %10s at %s"%(self._varname,str(dt)))
-      self.get_coords(dt)
-      self.get_grid(dt)
-
-      logger.info("Reading name %20s, varname=%20s"%(self._name,self._varname))
-      self._data=tmp
-      self._time=outdt
+      # Records read in advance by read_window are used once
+      if key in self._window :
+         tmp = self._window.pop(key)
+      else :
+         tmp = self._convert_record(self._fieldreader.get_timestep(self._varname,dt),mycfunit)
+
+      if keep :
+         self._records[key] = tmp
+         while len(self._records) > self._records_size :
+            self._records.popitem(last=False)
+      return tmp
+
+   def set_subset(self,targetlon,targetlat,halo=2) :
+      """ Only read the part of the field needed to interpolate to targetlon, targetlat. See FieldReader.set_subset """
+      self._fieldreader.set_subset(targetlon,targetlat,halo=halo)
+      self._records = collections.OrderedDict()
+      self._window  = {}
+
+   def _convert_record(self,record,mycfunit) :
+      # tmp is a new array here, so it can be converted in place
+      tmp = numpy.squeeze(record)*self._accumulation_scale_factor
+      return get_unit_converter(self._cfunit,mycfunit)(tmp,inplace=True)
+
+   def read_window(self,dts,unit=None) :
+      """ Read records needed by read_timestep for all times in dts, using slab reads of
+      contiguous time steps. The records are kept until used by read_timestep, or until the next
+      call to read_window. Time steps that can not be read are skipped here """
+      if unit is not None :
+         mycfunit = get_units(unit)
+      else :
+         mycfunit = self._cfunit
+      needed=[]
+      for dt in dts :
+         needed.append(dt)
+         if self._accumulation_time <> datetime.timedelta(0):
+            needed.append(dt + self._accumulation_time)
+      needed = sorted(set([elem for elem in needed if (elem,str(mycfunit)) not in self._records]))
+      logger.info("Reading %d time steps of varname=%s"%(len(needed),self._varname))
+      self._window = {}
+      for dt,record in zip(needed,self._fieldreader.get_timesteps(self._varname,needed,skip_missing=True)) :
+         if record is not None :
+            self._window[(dt,str(mycfunit))] = self._convert_record(record,mycfunit)
 
    def get_coords(self,dt) : 
       self._coordx,self._coordy =  self._fieldreader.get_coords(self._varname,dt)
@@ -317,7 +823,7 @@ class ForcingField(object) :
       return self._data
 
    def data_to_unit(self,newunit):
-      return cfunits.Units.conform(self.data ,self._cfunit,newunit)
+      return get_unit_converter(self._cfunit,newunit)(self.data)
            
    @property
    def time(self) : 
@@ -348,7 +854,11 @@ class ForcingFieldFromXml(ForcingField) :
       accumulation_time=None
       if "accumulated" in xml_element.attrib.keys() :
          accumulation_time=xml_element.attrib["accumulated"]
-      super(ForcingFieldFromXml,self).__init__(name,filenametemplate,varname,units,format,accumulation_time=accumulation_time,rootPath=rootPath,coord_props=coord_props)
+      time_tolerance=None
+      if "time_tolerance" in xml_element.attrib.keys() :
+         time_tolerance=xml_element.attrib["time_tolerance"]
+      super(ForcingFieldFromXml,self).__init__(name,filenametemplate,varname,units,format,accumulation_time=accumulation_time,rootPath=rootPath,
+            coord_props=coord_props,time_tolerance=time_tolerance)
 
 
 
@@ -361,7 +871,7 @@ class ForcingFieldCopy(ForcingField) :
       self._format           = None
       self._fieldreader      = None
       self._units            = unit
-      self._cfunit             = cfunits.Units(units=self._units)
+      self._cfunit             = get_units(self._units)
 
       # TODO: use ref or copy?
       self._gridx,self._gridy   = instance.grid
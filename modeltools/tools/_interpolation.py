@@ -8,8 +8,12 @@ import datetime
 import cfunits
 import netcdftime
 import scipy
+import collections
+import hashlib
+import threading
+import weakref
 
-class FieldInterpolatorError(object) :
+class FieldInterpolatorError(Exception) :
     """Base class for exceptions in this module."""
     pass
 
@@ -70,8 +74,14 @@ class FieldInterpolator(object) :
          self._flipy=False
 
 
+      # Index in x direction wraps for global longitude grids
+      self._wrapmode=("raise","raise")
       if x_is_longitude and abs(self._dx*self._nx - 360.0) < 1e-4:
          self._wrapmode=("raise","wrap")
+
+      # Target longitudes are put in range [x0,x0+360), x0 is smallest longitude of field
+      if x_is_longitude :
+         targetx = numpy.mod(targetx-self._x0,360.)+self._x0
       self._targetx=targetx
       self._targety=targety
 
@@ -154,6 +164,38 @@ class FieldInterpolatorRectBivariateSpline(FieldInterpolator)  :
       return self._intobj(self._targetx,self._targety,grid=False)
 
 
+# Interpolators shared between fields and time steps with identical coordinates. See get_field_interpolator
+_interpolator_cache = collections.OrderedDict()
+_interpolator_cache_size = 8
+_interpolator_lock = threading.Lock()
+
+def get_field_interpolator(cls,x,y,targetx,targety,x_is_longitude=True) :
+   """ Returns cls(x,y,targetx,targety,x_is_longitude), created once per unique x,y and
+   pair of read-only target arrays (as long as they exist). Interpolators for writable
+   target arrays are not cached """
+   readonly = [isinstance(elem,numpy.ndarray) and not elem.flags.writeable for elem in [targetx,targety]]
+   if not all(readonly) :
+      return cls(x,y,targetx,targety,x_is_longitude=x_is_longitude)
+   key=[cls,x_is_longitude,id(targetx),id(targety)]
+   for elem in [x,y] :
+      tmp = numpy.ascontiguousarray(numpy.ma.getdata(elem))
+      key.append((tmp.dtype.str,tmp.shape,hashlib.sha1(tmp.tobytes()).hexdigest()))
+   key = tuple(key)
+   with _interpolator_lock :
+      if key in _interpolator_cache :
+         xref,yref,fi = _interpolator_cache.pop(key)
+         if xref() is not targetx or yref() is not targety :
+            fi = None
+      else :
+         fi = None
+      if fi is None :
+         fi = cls(x,y,targetx,targety,x_is_longitude=x_is_longitude)
+      _interpolator_cache[key] = (weakref.ref(targetx),weakref.ref(targety),fi)
+      while len(_interpolator_cache) > _interpolator_cache_size :
+         _interpolator_cache.popitem(last=False)
+   return fi
+
+
 def extrapolate_data(infld,method) :
    outfld=numpy.ma.MaskedArray.copy(infld)
    mask=numpy.copy(outfld.mask)
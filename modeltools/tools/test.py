@@ -0,0 +1,215 @@
+import unittest
+import numpy
+import modeltools.tools
+
+class InterpolatorCacheTest(unittest.TestCase):
+    x=numpy.arange(0.,360.,2.5)
+    y=numpy.arange(-90.,90.1,2.5)
+
+    def target(self,readonly=True):
+       targetx,targety=numpy.meshgrid(numpy.linspace(-30,40,15),numpy.linspace(50,80,7))
+       for elem in [targetx,targety] : elem.flags.writeable=not readonly
+       return targetx,targety
+
+    def test_reuse(self):
+       targetx,targety=self.target()
+       cls=modeltools.tools.FieldInterpolatorBilinear
+       fi1=modeltools.tools.get_field_interpolator(cls,self.x,self.y,targetx,targety)
+       fi2=modeltools.tools.get_field_interpolator(cls,self.x.copy(),self.y.copy(),targetx,targety)
+       self.assertTrue(fi1 is fi2)
+
+       # Different source grid or target grid gives new interpolator
+       fi3=modeltools.tools.get_field_interpolator(cls,self.x+1.,self.y,targetx,targety)
+       self.assertTrue(fi3 is not fi1)
+       targetx2,targety2=self.target()
+       fi4=modeltools.tools.get_field_interpolator(cls,self.x,self.y,targetx2,targety2)
+       self.assertTrue(fi4 is not fi1)
+
+    def test_writable_target(self):
+       targetx,targety=self.target(readonly=False)
+       cls=modeltools.tools.FieldInterpolatorBilinear
+       fi1=modeltools.tools.get_field_interpolator(cls,self.x,self.y,targetx,targety)
+       fi2=modeltools.tools.get_field_interpolator(cls,self.x,self.y,targetx,targety)
+       self.assertTrue(fi1 is not fi2)
+
+    def test_interpolate(self):
+       targetx,targety=self.target()
+       fld=numpy.add.outer(self.y,self.x)
+       fi1=modeltools.tools.get_field_interpolator(modeltools.tools.FieldInterpolatorBilinear,self.x,self.y,targetx,targety)
+       fi2=modeltools.tools.FieldInterpolatorBilinear(self.x,self.y,targetx,targety)
+       self.assertTrue(numpy.all(fi1.interpolate(fld)==fi2.interpolate(fld)))
+       self.assertTrue(numpy.allclose(fi1.interpolate(fld),numpy.mod(targetx,360.)+targety))
+
+
+class UnitConverterTest(unittest.TestCase):
+    data=numpy.array([0.,1.,273.15,101325.,-40.])
+
+    def conform(self,from_unit,to_unit):
+       import cfunits
+       return numpy.asarray(cfunits.Units.conform(self.data,cfunits.Units(from_unit),cfunits.Units(to_unit)))
+
+    def test_affine(self):
+       conv=modeltools.tools.get_unit_converter("K","degC")
+       self.assertTrue(conv is modeltools.tools.get_unit_converter("K","degC"))
+       self.assertFalse(conv.is_identity)
+       self.assertTrue(conv.is_affine)
+       self.assertTrue(numpy.allclose([conv.scale,conv.offset],[1.,-273.15],rtol=1e-12,atol=0.))
+       self.assertTrue(numpy.allclose(conv(self.data),self.conform("K","degC"),rtol=1e-12,atol=1e-9))
+
+       # In place conversion
+       tmp=self.data.copy()
+       self.assertTrue(conv(tmp,inplace=True) is tmp)
+       self.assertTrue(numpy.allclose(tmp,self.conform("K","degC"),rtol=1e-12,atol=1e-9))
+
+    def test_linear(self):
+       conv=modeltools.tools.get_unit_converter("Pa","hPa")
+       self.assertFalse(conv.is_identity)
+       self.assertTrue(conv.is_affine)
+       self.assertTrue(numpy.allclose(conv.scale,0.01,rtol=1e-12,atol=0.))
+       self.assertEqual(conv.offset,0.)
+       self.assertTrue(numpy.allclose(conv(self.data),self.conform("Pa","hPa"),rtol=1e-12,atol=0.))
+
+    def test_identity(self):
+       conv=modeltools.tools.get_unit_converter("K","K")
+       self.assertTrue(conv.is_identity)
+       res=conv(self.data)
+       self.assertTrue(res is not self.data)
+       self.assertTrue(numpy.all(res==self.data))
+       self.assertTrue(conv(self.data,inplace=True) is self.data)
+       tmp=numpy.ma.masked_less(self.data,0.)
+       self.assertTrue(numpy.all(conv(tmp).mask==tmp.mask))
+
+
+class FieldReaderTest(unittest.TestCase):
+
+    def write_file(self,filename,lon=[0.,2.5,5.,7.5,10.],lat=[50.,52.5,55.,57.5]):
+       import netCDF4
+       modeltools.tools.netcdf_dataset_pool.close_all()   # File may be open from earlier tests
+       nc=netCDF4.Dataset(filename,"w")
+       nc.createDimension("time",None)
+       nc.createDimension("latitude",len(lat))
+       nc.createDimension("longitude",len(lon))
+       var=nc.createVariable("time","f8",("time",))
+       var.units="hours since 2000-01-01 00:00:00"
+       var.calendar="standard"
+       var[:]=[0.,6.,12.,18.]
+       var=nc.createVariable("latitude","f8",("latitude",))
+       var.units="degrees_north"
+       var[:]=lat
+       var=nc.createVariable("longitude","f8",("longitude",))
+       var.units="degrees_east"
+       var[:]=lon
+       var=nc.createVariable("T2","f4",("time","latitude","longitude"))
+       var.units="K"
+       var[:]=numpy.arange(4*len(lat)*len(lon)).reshape((4,len(lat),len(lon)))
+       nc.close()
+
+    def test_get_timesteps(self):
+       import datetime
+       self.write_file("test_reader.nc")
+       reader=modeltools.tools.NetcdfFieldReader("test_reader.nc")
+       dts=[datetime.datetime(2000,1,1,h) for h in [12,0,6]]
+       flds=reader.get_timesteps("T2",dts)
+       for fld,dt in zip(flds,dts) :
+          self.assertTrue(numpy.all(fld==reader.get_timestep("T2",dt)))
+
+       # Time not in file
+       dts=[datetime.datetime(2000,1,1,h) for h in [0,3,6]]
+       self.assertRaises(modeltools.tools._indata.FieldReaderError,reader.get_timesteps,"T2",dts)
+       flds=reader.get_timesteps("T2",dts,skip_missing=True)
+       self.assertTrue(flds[1] is None)
+       self.assertTrue(numpy.all(flds[2]==reader.get_timestep("T2",dts[2])))
+       reader.close()
+
+    def test_find_timestep(self):
+       import datetime
+       self.write_file("test_reader.nc")
+       dt=datetime.datetime(2000,1,1,6)
+       reader=modeltools.tools.NetcdfFieldReader("test_reader.nc")
+       reader.open_if_needed(dt)
+       self.failUnlessEqual(list(reader.find_timestep(dt,"T2")),[1])
+       self.failUnlessEqual(list(reader.find_timestep(dt+datetime.timedelta(minutes=30),"T2")),[])
+
+       # Nearest time within tolerance, given to reader or call
+       tol=datetime.timedelta(hours=1)
+       self.failUnlessEqual(list(reader.find_timestep(dt+datetime.timedelta(minutes=50),"T2",tolerance=tol)),[1])
+       self.failUnlessEqual(list(reader.find_timestep(dt-datetime.timedelta(minutes=50),"T2",tolerance=tol)),[1])
+       self.failUnlessEqual(list(reader.find_timestep(dt+datetime.timedelta(hours=2),"T2",tolerance=tol)),[])
+       self.failUnlessEqual(list(reader.find_timestep(datetime.datetime(2000,1,1,19),"T2",tolerance=tol)),[3])
+       reader=modeltools.tools.NetcdfFieldReader("test_reader.nc",time_tolerance=tol)
+       reader.open_if_needed(dt)
+       self.failUnlessEqual(list(reader.find_timestep(dt+datetime.timedelta(minutes=50),"T2")),[1])
+       self.failUnlessEqual(list(reader.find_timestep(dt+datetime.timedelta(minutes=70),"T2")),[])
+
+       # Tolerance set on forcing field
+       field=modeltools.tools.ForcingField("2t","test_reader.nc","T2","K","netcdf",time_tolerance="1h")
+       data=field.read_timestep(dt+datetime.timedelta(minutes=50))[0]
+       self.assertTrue(numpy.all(data==numpy.squeeze(reader.get_timestep("T2",dt))))
+       self.assertRaises(modeltools.tools._indata.FieldReaderError,modeltools.tools.ForcingField,
+             "2t","test_reader.nc","T2","K","netcdf",time_tolerance="1d")
+       reader.close()
+
+    def check_subset(self,lon,lat,targetlon,targetlat,nslices):
+       # Subset read of file with coordinates lon,lat must match full read
+       import datetime
+       self.write_file("test_reader.nc",lon=lon,lat=lat)
+       dt=datetime.datetime(2000,1,1,6)
+       reader=modeltools.tools.NetcdfFieldReader("test_reader.nc")
+       full=reader.get_timestep("T2",dt)[0]
+       reader.set_subset(targetlon,targetlat)
+       sub=reader.get_timestep("T2",dt)[0]
+       sublon,sublat=reader.get_coords("T2",dt)
+       self.failUnlessEqual(len(reader._subset_index[1]),nslices)
+       self.failUnlessEqual(sub.shape,(len(sublat),len(sublon)))
+
+       # Same values at same coordinates (subset longitudes may be shifted by 360 degrees)
+       lon=numpy.array(lon)
+       cols=[numpy.where(numpy.mod(lon-elem,360.)==0.)[0][0] for elem in sublon]
+       rows=[lat.index(elem) for elem in sublat]
+       self.assertTrue(numpy.all(sub==full[rows,:][:,cols]))
+
+       # Interpolated to target from subset and from full field
+       cls=modeltools.tools.FieldInterpolatorBilinear
+       fld1=cls(numpy.array(sublon),numpy.array(sublat),targetlon,targetlat).interpolate(sub)
+       fld2=cls(lon,numpy.array(lat),targetlon,targetlat).interpolate(full)
+       self.assertTrue(numpy.allclose(fld1,fld2,rtol=1e-12,atol=0.))
+       reader.close()
+       return sublon,sublat
+
+    def test_subset_dateline(self):
+       # Global 0..360 source, target crossing 0 degrees. Decreasing latitude
+       lon=list(numpy.arange(0.,360.,2.5))
+       lat=list(numpy.arange(90.,-90.1,-2.5))
+       targetlon,targetlat=numpy.meshgrid(numpy.linspace(-20.,25.,10),numpy.linspace(50.,70.,6))
+       self.check_subset(lon,lat,targetlon,targetlat,2)
+
+       # Global -180..180 source, target crossing 180 degrees
+       lon=list(numpy.arange(-180.,180.,2.5))
+       lat=list(numpy.arange(-90.,90.1,2.5))
+       targetlon,targetlat=numpy.meshgrid(numpy.linspace(160.,200.,10),numpy.linspace(-30.,10.,6))
+       self.check_subset(lon,lat,targetlon,targetlat,2)
+
+       # Target inside source range
+       targetlon,targetlat=numpy.meshgrid(numpy.linspace(-40.,-10.,10),numpy.linspace(-30.,10.,6))
+       self.check_subset(lon,lat,targetlon,targetlat,1)
+
+    def test_subset_polar(self):
+       # Target around the pole needs all longitudes, latitudes are cut at the pole
+       lon=list(numpy.arange(0.,360.,2.5))
+       lat=list(numpy.arange(90.,-90.1,-2.5))
+       targetlon,targetlat=numpy.meshgrid(numpy.linspace(0.,359.,30),numpy.linspace(80.,89.5,5))
+       sublon,sublat=self.check_subset(lon,lat,targetlon,targetlat,1)
+       self.failUnlessEqual(len(sublon),len(lon))
+       self.failUnlessEqual(sublat[0],90.)
+
+       # Regional source, target at edge of source
+       lon=list(numpy.arange(-30.,30.1,2.5))
+       lat=list(numpy.arange(60.,90.1,2.5))
+       targetlon,targetlat=numpy.meshgrid(numpy.linspace(-29.,29.,10),numpy.linspace(80.,89.5,5))
+       sublon,sublat=self.check_subset(lon,lat,targetlon,targetlat,1)
+       self.failUnlessEqual(len(sublon),len(lon))
+       self.failUnlessEqual(sublat[-1],90.)
+
+
+if __name__ == "__main__" :
+   unittest.main()